@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Detachable sessions, like dtach(1).
+
+A session runs in a daemon that owns its pty, and is served on a Unix
+socket. Attaching clients get a snapshot of the current screen rather
+than a replay of all output, so reattaching takes as long after a day
+as after a second. ^\\ (or the key given with -e) detaches.
+
+$ python3 ./detach.py -n /tmp/fish sh    # start sh, detached
+$ python3 ./detach.py -a /tmp/fish       # attach, relayed through the daemon
+$ python3 ./detach.py -a -m fd /tmp/fish # attach, with the pty master itself
+$ python3 ./detach.py -A /tmp/fish sh    # attach, starting sh if need be
+"""
+import argparse
+import os
+import sys
+import tty
+import pty2
+
+def start(path, argv):
+    """Starts a pty2.Session daemon; returns once it is listening."""
+    try:
+        mode = tty.tcgetattr(pty2.STDIN_FILENO)
+    except tty.error:
+        mode = None
+    winsz = None
+    if mode and tty.HAVE_WINSZ:
+        winsz = tty.tcgetwinsize(pty2.STDIN_FILENO)
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == pty2.CHILD:
+        try:
+            os.close(r)
+            os.setsid()
+            if os.fork() != pty2.CHILD:
+                os._exit(0)
+            session = pty2.Session(argv, path, mode, winsz)
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (pty2.STDIN_FILENO, pty2.STDOUT_FILENO,
+                       pty2.STDERR_FILENO):
+                os.dup2(null, fd)
+            os.close(null)
+            os.write(w, b"\0")
+            os.close(w)
+            session.serve()
+        finally:
+            os._exit(0)
+    os.close(w)
+    started = os.read(r, 1)
+    os.close(r)
+    os.waitpid(pid, 0)
+    if not started:
+        sys.exit("detach.py: cannot start a session on %s" % path)
+
+def key(s):
+    """Parses a detach key such as ^\\ or ^A."""
+    if len(s) == 2 and s[0] == "^":
+        return bytes([ord(s[1].upper()) ^ 0x40])
+    return s.encode()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-n', dest='new', action='store_true',
+                       help='start a session without attaching')
+    group.add_argument('-a', dest='attach', action='store_true',
+                       help='attach to a session')
+    group.add_argument('-A', dest='create', action='store_true',
+                       help='attach to a session, starting it if need be')
+    parser.add_argument('-m', dest='mode', default='stream',
+                        choices=['stream', 'replay', 'fd'])
+    parser.add_argument('-e', dest='key', type=key, default=b'\x1c',
+                        help='detach key, like ^\\')
+    parser.add_argument('socket')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    options = parser.parse_args()
+
+    if (options.new or options.create) and not options.command:
+        parser.error('a command is required')
+    if options.new or options.create and not os.path.exists(options.socket):
+        start(options.socket, options.command)
+    if options.new:
+        sys.exit()
+
+    status = pty2.attach(options.socket, options.mode, options.key)
+    if status is None:
+        print('[detached]')
+    else:
+        sys.exit(os.waitstatus_to_exitcode(status))
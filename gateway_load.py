@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Load test for pty2.Gateway.
+
+Serves a command with a Gateway on a Unix socket (or TCP with -p), and
+runs that many stand-in clients against it in the same event loop. Each
+client sends its lines one at a time, waiting for each to come back
+from the pty -e times (by default twice: the echo, and what cat
+writes), then sends EOF (^D) and waits for the EXIT frame.
+Reports connection, round-trip and session times.
+
+$ python3 ./gateway_load.py -n 1000 -m 20 cat
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+from struct import unpack
+import pty2
+
+async def client(connect, messages, size, echoes):
+    """Returns (connect time, round-trip times, session time, bytes)."""
+    start = time.perf_counter()
+    reader, writer = await connect()
+    connected = time.perf_counter()
+    frames = pty2.FrameReader()
+    output = bytearray()
+    received = 0
+    rtts = []
+    status = None
+
+    async def until(marker, count=1):
+        nonlocal received, status
+        while output.count(marker) < count:
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            received += len(data)
+            for type, payload in frames.feed(data):
+                if type == pty2.FRAME_DATA:
+                    output.extend(payload)
+                elif type == pty2.FRAME_EXIT:
+                    status = unpack(">i", payload)[0]
+                    return
+
+    for i in range(messages):
+        line = b"%d " % i + b"x" * max(0, size - 8)
+        sent = time.perf_counter()
+        writer.write(pty2.frame(pty2.FRAME_DATA, line + b"\r"))
+        await until(line + b"\r\n", echoes)
+        rtts.append(time.perf_counter() - sent)
+        del output[:]
+    writer.write(pty2.frame(pty2.FRAME_DATA, b"\x04"))
+    while status is None:
+        await until(b"\0")
+    writer.close()
+    return connected - start, rtts, time.perf_counter() - start, received
+
+def percentiles(times):
+    times = sorted(times)
+    pick = lambda p: times[min(len(times) - 1, int(p * len(times)))]
+    return "p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        pick(0.5) * 1e3, pick(0.99) * 1e3, times[-1] * 1e3)
+
+async def main(options):
+    gateway = pty2.Gateway(options.command)
+    if options.port is None:
+        path = os.path.join(tempfile.mkdtemp(), "gateway")
+        server = await gateway.serve_unix(path, backlog=options.clients)
+        connect = lambda: asyncio.open_unix_connection(path)
+    else:
+        server = await gateway.serve_tcp("127.0.0.1", options.port,
+                                         backlog=options.clients)
+        port = server.sockets[0].getsockname()[1]
+        connect = lambda: asyncio.open_connection("127.0.0.1", port)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(client(connect, options.messages, options.size, options.echoes)
+          for _ in range(options.clients)),
+        return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    server.close()
+    await server.wait_closed()
+    if options.port is None:
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+    failed = [r for r in results if isinstance(r, BaseException)]
+    results = [r for r in results if not isinstance(r, BaseException)]
+    print("%d clients, %d failed, in %.2f s" % (options.clients, len(failed),
+                                                elapsed))
+    if failed:
+        print("first failure:", repr(failed[0]))
+    if results:
+        rtts = [t for r in results for t in r[1]]
+        print("connect:   ", percentiles([r[0] for r in results]))
+        if rtts:
+            print("round trip:", percentiles(rtts))
+        print("session:   ", percentiles([r[2] for r in results]))
+        print("%.1f MB/s received, %.0f round trips/s" % (
+            sum(r[3] for r in results) / elapsed / 1e6, len(rtts) / elapsed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', dest='clients', type=int, default=100)
+    parser.add_argument('-m', dest='messages', type=int, default=10,
+                        help='lines each client sends')
+    parser.add_argument('-s', dest='size', type=int, default=64,
+                        help='length of the lines')
+    parser.add_argument('-e', dest='echoes', type=int, default=2,
+                        help='times each line comes back')
+    parser.add_argument('-p', dest='port', type=int,
+                        help='use TCP on this port (0: any) instead')
+    parser.add_argument('command', nargs='*', default=['cat'])
+    options = parser.parse_args()
+
+    # A pty, a socket and a client per session.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 4 * options.clients + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    asyncio.run(main(options))
@@ -14,14 +14,29 @@
 # v1 author: Steen Lumholt -- with additions by Guido.
 # Copyright (C) 2001-2020 Python Software Foundation; All Rights Reserved
 
-from select import select
+from select import select, poll, POLLIN, POLLHUP
 from fcntl import ioctl
+from collections import namedtuple, deque
+from struct import pack, unpack
+import codecs
+import errno
+import math
+import queue
+import selectors
+import socket
+import threading
+import zlib
 import os
+import re
 import sys
+import time
 import tty
 import signal
 
-__all__ = ["openpty", "fork", "spawn"]
+__all__ = ["openpty", "openpty_many", "fork", "spawn", "run", "stream", "run_many",
+           "RunResult", "Feeder", "RateLimit", "TimerWheel", "Watchdog", "Reaper", "reaper", "Pipeline", "AnsiStripper", "Utf8Decoder",
+           "Redactor", "Compressor", "NewlineNormalizer", "OSBackend", "LoopbackBackend",
+           "frame", "FrameReader", "Session", "attach"]
 
 STDIN_FILENO = 0
 STDOUT_FILENO = 1
@@ -41,11 +56,67 @@ if HAVE_WINSZ and hasattr(signal, "SIGWINCH"):
 else:
     HAVE_WINCH = False
 
-def openpty(mode=None, winsz=None, name=False):
+# Linux ioctls on /dev/ptmx that termios does not export. Their numbers
+# are those of the asm-generic encoding, hence the list of machines.
+_TIOCGPTN = getattr(tty, "TIOCGPTN", 0x80045430)
+_TIOCSPTLCK = getattr(tty, "TIOCSPTLCK", 0x40045431)
+_TIOCGPTPEER = getattr(tty, "TIOCGPTPEER", 0x5441)
+
+if sys.platform.startswith("linux") and os.uname().machine in (
+        "x86_64", "i386", "i486", "i586", "i686", "aarch64", "arm64",
+        "armv6l", "armv7l", "armv8l", "riscv64", "s390x", "loongarch64"):
+    HAVE_PTPEER = True
+else:
+    HAVE_PTPEER = False
+
+def _ptpeer(master_fd):
+    """Opens the slave of master_fd without looking up its path
+    (TIOCGPTPEER, Linux >= 4.13)."""
+    return ioctl(master_fd, _TIOCGPTPEER,
+                 os.O_RDWR | os.O_NOCTTY | os.O_CLOEXEC)
+
+def _openpt(nonblock):
+    """Linux openpty(): opens /dev/ptmx with all flags set at once,
+    unlocks it, and gets the slave from it with TIOCGPTPEER."""
+    flags = os.O_RDWR | os.O_NOCTTY | os.O_CLOEXEC
+    if nonblock:
+        flags |= os.O_NONBLOCK
+    master_fd = os.open("/dev/ptmx", flags)
+    try:
+        ioctl(master_fd, _TIOCSPTLCK, pack("i", 0)) # unlockpt()
+        slave_fd = _ptpeer(master_fd)
+    except OSError:
+        os.close(master_fd)
+        raise
+    return master_fd, slave_fd
+
+def _ptsname(master_fd):
+    """ptsname() of a master opened by _openpt()."""
+    return "/dev/pts/%d" % unpack("I", ioctl(master_fd, _TIOCGPTN,
+                                             b"\0" * 4))[0]
+
+def openpty(mode=None, winsz=None, name=False, nonblock=False):
     """openpty() -> (master_fd, slave_fd)
-    Open a pty master/slave pair, using os.openpty() if possible."""
+    Open a pty master/slave pair, using os.openpty() if possible. On
+    Linux, /dev/ptmx is opened directly instead, so that the master can
+    be made non-blocking (nonblock) as it is opened and the slave is
+    obtained without a path lookup."""
+    global HAVE_PTPEER
 
-    master_fd, slave_fd = os.openpty()
+    master_fd = None
+    if HAVE_PTPEER:
+        try:
+            master_fd, slave_fd = _openpt(nonblock)
+        except OSError as e:
+            # Kernel older than 4.13, or no /dev/ptmx; anything else,
+            # such as EMFILE, is not a reason to give up on it.
+            if e.errno not in (errno.ENOENT, errno.ENOTTY, errno.EINVAL):
+                raise
+            HAVE_PTPEER = False
+    if master_fd is None:
+        master_fd, slave_fd = os.openpty()
+        if nonblock:
+            os.set_blocking(master_fd, False)
 
     if mode:
         tty.tcsetattr(slave_fd, tty.TCSAFLUSH, mode)
@@ -53,10 +124,27 @@ def openpty(mode=None, winsz=None, name=False):
         tty.tcsetwinsize(slave_fd, winsz)
 
     if name:
+        if HAVE_PTPEER:
+            return master_fd, slave_fd, _ptsname(master_fd)
         return master_fd, slave_fd, os.ttyname(slave_fd)
     else:
         return master_fd, slave_fd
 
+def openpty_many(n, mode=None, winsz=None, nonblock=False):
+    """openpty_many(n) -> [(master_fd, slave_fd), ...]
+    Open n pty master/slave pairs like openpty(). If any of them cannot
+    be opened, those already opened are closed again."""
+    pairs = []
+    try:
+        for _ in range(n):
+            pairs.append(openpty(mode, winsz, nonblock=nonblock))
+    except:
+        for fds in pairs:
+            for fd in fds:
+                os.close(fd)
+        raise
+    return pairs
+
 def fork(mode=None, winsz=None):
     """fork() -> (pid, master_fd)
     Fork and make the child a session leader with a controlling terminal."""
@@ -84,10 +172,36 @@ def fork(mode=None, winsz=None):
 
     return pid, master_fd
 
-def _writen(fd, data):
+def _exec(argv, master_fd, slave_fd, saved_mask=None):
+    """Forks a child that runs argv with the slave as its controlling
+    terminal, restoring the signal mask saved_mask if given. Closes
+    slave_fd in the parent. Returns pid of child."""
+    pid = os.fork()
+    if pid == CHILD:
+        try:
+            os.close(master_fd)
+            os.login_tty(slave_fd)
+            if saved_mask is not None:
+                _sigreset(saved_mask)
+            os.execlp(argv[0], *argv)
+        finally:
+            os._exit(127)
+
+    os.close(slave_fd)
+    return pid
+
+def _killpg(pid, sig):
+    """Sends sig to the process group led by pid; ignores a
+    group that has already gone away."""
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+def _writen(fd, data, write=os.write):
     """Write all the data to a descriptor."""
     while data:
-        n = os.write(fd, data)
+        n = write(fd, data)
         data = data[n:]
 
 def _read(fd):
@@ -106,36 +220,37 @@ def _sigreset(saved_mask):
     """Restores signal mask."""
     signal.pthread_sigmask(signal.SIG_SETMASK, saved_mask)
 
-def _pty_setup(slave_echo):
+def _pty_setup(slave_echo, backend):
     """Opens a pty pair. If current stdin is a tty, then
     applies current stdin's termios and winsize to the slave,
     sets current stdin to raw mode. Returns (master, slave,
     original stdin mode/None, stdin winsize/None)."""
     mode = None
     winsz = None
+    stdin_fd = backend.stdin_fd
     try:
-        mode = tty.tcgetattr(STDIN_FILENO)
+        mode = backend.tcgetattr(stdin_fd)
     except tty.error:
-        master_fd, slave_fd = openpty()
+        master_fd, slave_fd = backend.openpty()
 
-        _mode = tty.tcgetattr(slave_fd)
+        _mode = backend.tcgetattr(slave_fd)
         tty.mode_echo(_mode, slave_echo)
-        tty.tcsetattr(slave_fd, tty.TCSAFLUSH, _mode)
+        backend.tcsetattr(slave_fd, tty.TCSAFLUSH, _mode)
     else:
         if tty.HAVE_WINSZ:
-            winsz = tty.getwinsize(STDIN_FILENO)
+            winsz = backend.tcgetwinsize(stdin_fd)
 
         _mode = list(mode)
         tty.mode_echo(_mode, slave_echo)
 
-        master_fd, slave_fd = openpty(_mode, winsz)
+        master_fd, slave_fd = backend.openpty(_mode, winsz)
 
         tty.mode_raw(_mode)
-        tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, _mode)
+        backend.tcsetattr(stdin_fd, tty.TCSAFLUSH, _mode)
 
     return master_fd, slave_fd, mode, winsz
 
-def _winchset(slave_fd, saved_mask, handle_winch):
+def _winchset(master_fd, slave_fd, saved_mask, handle_winch):
     """Installs SIGWINCH handler. Returns old SIGWINCH
     handler if relevant; returns None otherwise."""
     bkh = None
@@ -143,86 +258,2370 @@ def _winchset(slave_fd, saved_mask, handle_winch):
         def _hwinch(signum, frame):
             """SIGWINCH handler."""
             _sigblock()
-            new_slave_fd = os.open(slave_path, os.O_RDWR)
+            if slave_path is None:
+                new_slave_fd = _ptpeer(master_fd)
+            else:
+                new_slave_fd = os.open(slave_path, os.O_RDWR)
             tty.setwinsize(new_slave_fd, tty.getwinsize(STDIN_FILENO))
             os.close(new_slave_fd)
             _sigreset(saved_mask)
 
-        slave_path = os.ttyname(slave_fd)
+        slave_path = None if HAVE_PTPEER else os.ttyname(slave_fd)
         try:
             # Raises ValueError if not called from main thread.
-            bkh = signal.signal(SIGWINCH, _hwinch)
+            bkh = signal.signal(signal.SIGWINCH, _hwinch)
         except ValueError:
             pass
 
     return bkh
 
-def _copy(master_fd, saved_mask=set(), master_read=_read, stdin_read=_read):
+class RateLimit:
+    """Token bucket for the output of a session: rate bytes per second,
+    in bursts of up to burst bytes (default: rate). A session over budget
+    is not read from, so that the kernel holds its child back once the
+    pty fills up; if drop is true, its output is read and discarded
+    instead, and a note of how much was suppressed comes before the next
+    output that is let through. If auto is given, the limit only comes
+    into force once the session has sustained more than auto bytes per
+    second over window seconds, and then stays in force."""
+
+    def __init__(self, rate, burst=None, drop=False, auto=None, window=1.0):
+        self.rate = rate
+        self.burst = burst or rate
+        self.drop = drop
+        self.auto = auto
+        self.window = window
+        self.engaged = auto is None
+        self.suppressed = 0
+        self.tokens = self.burst
+        self._stamp = self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _watch(self, n, now):
+        """Engages the limit if the session sustains more than auto."""
+        self._window_bytes += n
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            if self._window_bytes > self.auto * elapsed:
+                self.engaged = True
+                self.tokens = self.burst
+                self._stamp = now
+            self._window_start = now
+            self._window_bytes = 0
+
+    def delay(self):
+        """Returns how many seconds to wait before reading from the
+        session again; 0 if it may be read from now."""
+        if not self.engaged or self.drop:
+            return 0
+        self._refill(time.monotonic())
+        if self.tokens > 0:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def admit(self, data):
+        """Accounts for data read from the session. Returns what is to be
+        written out."""
+        now = time.monotonic()
+        if not self.engaged:
+            self._watch(len(data), now)
+            return data
+        self._refill(now)
+        if not self.drop:
+            # Tokens may go negative; delay() makes up for it.
+            self.tokens -= len(data)
+            return data
+        if self.tokens < len(data):
+            self.suppressed += len(data)
+            return b""
+        self.tokens -= len(data)
+        return self.flush() + data
+
+    def flush(self):
+        """Returns the note of suppressed output, if any."""
+        if not self.suppressed:
+            return b""
+        note = b"\r\n[%d bytes suppressed]\r\n" % self.suppressed
+        self.suppressed = 0
+        return note
+
+class _Timer:
+    __slots__ = ("tick", "callback", "args", "slot", "level")
+
+class TimerWheel:
+    """TimerWheel(tick=0.01, slots=64, levels=4, clock=time.monotonic)
+    Hierarchical timing wheel: levels wheels of slots slots each, a slot
+    of level n spanning slots**n ticks of tick seconds. A timer is filed
+    in the lowest level that can hold it, and moves down a level as the
+    wheel above turns onto its slot, so that schedule() and cancel() take
+    constant time. Timers fire when advance() is called, no earlier than
+    asked and at most a tick later; timeout() tells how long a poll may
+    sleep until then, so that nothing wakes up just to look at timers."""
+
+    def __init__(self, tick=0.01, slots=64, levels=4, clock=time.monotonic):
+        if slots < 2 or slots & (slots - 1):
+            raise ValueError("slots must be a power of 2")
+        self.tick = tick
+        self.clock = clock
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._counts = [0] * levels
+        self._due = {}  # expired; fired by the next advance()
+        self._far = {}  # beyond the top level
+        self._now = int(clock() / tick)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _file(self, timer):
+        t = timer.tick
+        now = self._now
+        level = -1
+        slot = self._due
+        if t > now:
+            # The lowest level above which t and now agree.
+            for level, wheel in enumerate(self._wheels):
+                shift = self._bits * (level + 1)
+                if t >> shift == now >> shift:
+                    slot = wheel[(t >> (shift - self._bits)) & self._mask]
+                    self._counts[level] += 1
+                    break
+            else:
+                level += 1
+                slot = self._far
+        slot[timer] = None
+        timer.slot = slot
+        timer.level = level
+
+    def schedule(self, when, callback, *args):
+        """Calls callback(*args) once clock() has reached when; returns a
+        timer for cancel()."""
+        timer = _Timer()
+        timer.tick = math.ceil(when / self.tick)
+        timer.callback = callback
+        timer.args = args
+        self._file(timer)
+        self._len += 1
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Calls callback(*args) delay seconds from now."""
+        return self.schedule(self.clock() + delay, callback, *args)
+
+    def cancel(self, timer):
+        """Cancels timer, unless it has fired already."""
+        if timer.slot is not None:
+            del timer.slot[timer]
+            if 0 <= timer.level < len(self._counts):
+                self._counts[timer.level] -= 1
+            timer.slot = None
+            self._len -= 1
+
+    def _next(self):
+        """Returns the next tick at which a timer fires or moves down a
+        level; None if there are no timers."""
+        now = self._now
+        for level, wheel in enumerate(self._wheels):
+            if not self._counts[level]:
+                continue
+            # Timers of a level are all later than those below, and in
+            # slots after the current one.
+            shift = self._bits * level
+            base = now >> shift
+            current = base & self._mask
+            for i in range(current + 1, self._mask + 1):
+                if wheel[i]:
+                    return (base - current + i) << shift
+        if self._far:
+            # Where the top level turns onto the earliest of them.
+            shift = self._bits * len(self._wheels)
+            return min(timer.tick for timer in self._far) >> shift << shift
+        return None
+
+    def _turn(self, tick):
+        """Moves the clock of the wheels on to tick."""
+        self._now = tick
+        if self._far and not tick & ((1 << self._bits * len(self._wheels)) - 1):
+            far, self._far = self._far, {}
+            for timer in far:
+                self._file(timer)
+        for level in range(len(self._wheels) - 1, -1, -1):
+            shift = self._bits * level
+            if tick & ((1 << shift) - 1):
+                continue
+            wheel = self._wheels[level]
+            i = (tick >> shift) & self._mask
+            slot = wheel[i]
+            if slot:
+                wheel[i] = {}
+                self._counts[level] -= len(slot)
+                for timer in slot:
+                    self._file(timer)
+
+    def timeout(self):
+        """Returns the seconds until the next timer needs advance(); None
+        if there are no timers."""
+        if self._due:
+            return 0
+        tick = self._next()
+        if tick is None:
+            return None
+        return max(0, tick * self.tick - self.clock())
+
+    def advance(self, now=None):
+        """Fires the timers that have expired by now (default: clock()).
+        Returns how many fired."""
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        if (target + 1) * self.tick <= now:
+            # Rounded down; timeout() reckons in time, not ticks.
+            target += 1
+        fired = 0
+        while True:
+            due, self._due = self._due, {}
+            while due:
+                timer = next(iter(due))
+                del due[timer]
+                timer.slot = None
+                self._len -= 1
+                fired += 1
+                timer.callback(*timer.args)
+            tick = self._next()
+            if tick is None or tick > target:
+                break
+            self._turn(tick)
+        if target > self._now:
+            self._now = target
+        return fired
+
+# Sent to the process group of a session whose Watchdog expires, each
+# grace seconds after the one before.
+_ESCALATION = (signal.SIGHUP, signal.SIGTERM, signal.SIGKILL)
+
+class Watchdog:
+    """Watchdog(wheel, pid, idle=None, deadline=None, grace=None)
+    Idle and deadline timeouts of the session led by pid, on wheel, a
+    TimerWheel. Once the session has had no output for idle seconds (see
+    activity()), or deadline seconds after the Watchdog was created, it
+    expires: expired becomes "idle" or "deadline", and the process group
+    is sent SIGHUP, SIGTERM and SIGKILL, grace seconds apart, or SIGKILL
+    only if grace is None, until stop() is called."""
+
+    def __init__(self, wheel, pid, idle=None, deadline=None, grace=None):
+        self.wheel = wheel
+        self.pid = pid
+        self.idle = idle
+        self.grace = grace
+        self.expired = None
+        self._last = wheel.clock()
+        self._timers = {}
+        if deadline is not None:
+            self._timers["deadline"] = wheel.call_later(deadline, self._expire,
+                                                        "deadline")
+        if idle is not None:
+            self._timers["idle"] = wheel.call_later(idle, self._idle)
+
+    def activity(self):
+        """Notes output from the session."""
+        # The idle timer is moved only when it fires, not on every read.
+        self._last = self.wheel.clock()
+
+    def _idle(self):
+        when = self._last + self.idle
+        if when > self.wheel.clock():
+            self._timers["idle"] = self.wheel.schedule(when, self._idle)
+        else:
+            self._expire("idle")
+
+    def _expire(self, reason):
+        self.stop()
+        self.expired = reason
+        self._escalate(_ESCALATION if self.grace is not None
+                       else (signal.SIGKILL,))
+
+    def _escalate(self, signals):
+        _killpg(self.pid, signals[0])
+        if len(signals) > 1:
+            self._timers["kill"] = self.wheel.call_later(self.grace,
+                                                         self._escalate,
+                                                         signals[1:])
+
+    def stop(self):
+        """Cancels the timeouts, and any escalation under way."""
+        for timer in self._timers.values():
+            self.wheel.cancel(timer)
+        self._timers.clear()
+
+# Longest time _copy() keeps copying output before it looks at
+# standard input again.
+_SLICE = 0.002
+
+def _ready(fds):
+    """Returns those of fds that are readable right now."""
+    p = poll()
+    for fd in fds:
+        p.register(fd, POLLIN)
+    return [fd for fd, ev in p.poll(0) if ev & (POLLIN | POLLHUP)]
+
+def _copy(master_fd, saved_mask=set(), master_read=_read, stdin_read=_read,
+          limit=None, backend=None, watchdog=None):
     """Parent copy loop for spawn.
     Copies
             pty master -> standard output   (master_read)
             standard input -> pty master    (stdin_read)
+    Standard input is serviced first, so that keystrokes such as an
+    interrupt never wait behind output; output is then copied for up to
+    _SLICE seconds, or until standard input becomes readable. If limit,
+    a RateLimit, is given, the output is subject to it. Descriptors are
+    selected, read and written through backend (see OSBackend), which
+    also names standard input and output. If watchdog, a Watchdog, is
+    given, it is told of output, and select() sleeps no longer than its
+    TimerWheel allows.
     To exit from this loop
         A. FreeBSD, OpenBSD, NetBSD return no data upon reading master EOF,
         B. Linux throws OSError when trying to read from master when
             1. ALL descriptors of slave are closed in parent AND
             2. child has exited."""
-    fds = [master_fd, STDIN_FILENO]
+    if backend is None:
+        backend = _os_backend
+    if master_read is _read:
+        master_read = backend.read
+    if stdin_read is _read:
+        stdin_read = backend.read
+    stdin_fd = backend.stdin_fd
+    stdout_fd = backend.stdout_fd
+
+    fds = [master_fd, stdin_fd]
     args = [fds, [], []]
     while True:
+        _args = args
+        if limit is not None and master_fd in fds:
+            wait = limit.delay()
+            if wait:
+                # Over budget: leave the master alone for now.
+                _args = [[fd for fd in fds if fd != master_fd], [], [], wait]
+        if watchdog is not None and master_fd in fds:
+            wait = watchdog.wheel.timeout()
+            if wait is not None and (_args is args or wait < _args[3]):
+                _args = [_args[0], [], [], wait]
         _sigreset(saved_mask)
-        rfds = select(*args)[0]
+        rfds = backend.select(*_args)[0]
         _sigblock()
+        if watchdog is not None:
+            watchdog.wheel.advance()
         if not rfds:
-            return
-        if master_fd in rfds:
-            try:
-                data = master_read(master_fd)
-            except OSError:
-                data = b""
+            if _args is args:
+                return
+            continue
+        if stdin_fd in rfds:
+            data = stdin_read(stdin_fd)
             if not data:
-                fds.remove(master_fd)
-                args.append(0.01) # set timeout
+                fds.remove(stdin_fd)
             else:
-                os.write(STDOUT_FILENO, data)
-        if STDIN_FILENO in rfds:
-            data = stdin_read(STDIN_FILENO)
-            if not data:
-                fds.remove(STDIN_FILENO)
-            else:
-                _writen(master_fd, data)
+                _writen(master_fd, data, backend.write)
+        if master_fd in rfds:
+            deadline = time.monotonic() + _SLICE
+            while True:
+                try:
+                    data = master_read(master_fd)
+                except OSError:
+                    data = b""
+                if not data:
+                    if limit is not None:
+                        _writen(stdout_fd, limit.flush(), backend.write)
+                    fds.remove(master_fd)
+                    args.append(0.01) # set timeout
+                    break
+                if watchdog is not None:
+                    watchdog.activity()
+                if limit is not None:
+                    data = limit.admit(data)
+                    if data:
+                        backend.write(stdout_fd, data)
+                    if limit.delay():
+                        break
+                else:
+                    backend.write(stdout_fd, data)
+                if time.monotonic() >= deadline:
+                    break
+                ready = backend.ready(fds)
+                if stdin_fd in ready or master_fd not in ready:
+                    break
 
-def spawn(argv, master_read=_read, stdin_read=_read, slave_echo=True, handle_winch=False):
-    """Spawn a process."""
+def spawn(argv, master_read=_read, stdin_read=_read, slave_echo=True, handle_winch=False,
+          limit=None, idle=None, deadline=None, grace=None, backend=None):
+    """Spawn a process. If limit, a RateLimit, is given, the output of
+    the process is subject to it. idle, deadline and grace are as for
+    Watchdog, which the process is subject to if either of the first two
+    is given. The pty is opened, the process started and waited for, and
+    its input and output copied, through backend (see OSBackend)."""
     if type(argv) == type(''):
         argv = (argv,)
     sys.audit('pty.spawn', argv)
+    if backend is None:
+        backend = _os_backend
 
     saved_mask = _getmask()
     _sigblock() # Reset during select() in _copy.
 
-    master_fd, slave_fd, mode, winsz = _pty_setup(slave_echo)
-    handle_winch = handle_winch and (winsz != None) and HAVE_WINCH
-    bkh = _winchset(slave_fd, saved_mask, handle_winch)
+    master_fd, slave_fd, mode, winsz = _pty_setup(slave_echo, backend)
+    handle_winch = handle_winch and (winsz != None) and HAVE_WINCH and \
+                   isinstance(backend, OSBackend)
+    bkh = _winchset(master_fd, slave_fd, saved_mask, handle_winch)
 
-    pid = os.fork()
-    if pid == CHILD:
-        os.close(master_fd)
-        os.login_tty(slave_fd)
-        _sigreset(saved_mask)
-        os.execlp(argv[0], *argv)
-
-    os.close(slave_fd)
+    pid = backend.exec(argv, master_fd, slave_fd, saved_mask)
 
+    watchdog = None
+    if idle is not None or deadline is not None:
+        watchdog = Watchdog(TimerWheel(), pid, idle, deadline, grace)
     try:
-        _copy(master_fd, saved_mask, master_read, stdin_read)
+        _copy(master_fd, saved_mask, master_read, stdin_read, limit,
+              backend, watchdog)
     finally:
+        if watchdog is not None:
+            watchdog.stop()
         if mode:
-            tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, mode)
+            backend.tcsetattr(backend.stdin_fd, tty.TCSAFLUSH, mode)
 
     if bkh:
-        signal.signal(SIGWINCH, bkh)
-    os.close(master_fd)
+        signal.signal(signal.SIGWINCH, bkh)
+    backend.close(master_fd)
     _sigreset(saved_mask)
 
-    return os.waitpid(pid, 0)[1]
+    return backend.waitpid(pid, 0)[1]
+
+class OSBackend:
+    """The operating system's ptys, descriptors and processes; the
+    backend spawn() and _copy() use by default. Anything with the same
+    methods can stand in for it, see LoopbackBackend."""
+
+    @property
+    def stdin_fd(self):
+        return STDIN_FILENO
+
+    @property
+    def stdout_fd(self):
+        return STDOUT_FILENO
+
+    def openpty(self, mode=None, winsz=None):
+        return openpty(mode, winsz)
+
+    def exec(self, argv, master_fd, slave_fd, saved_mask=None):
+        return _exec(argv, master_fd, slave_fd, saved_mask)
+
+    def read(self, fd, n=1024):
+        return os.read(fd, n)
+
+    def write(self, fd, data):
+        return os.write(fd, data)
+
+    def close(self, fd):
+        os.close(fd)
+
+    def select(self, *args):
+        return select(*args)
+
+    def ready(self, fds):
+        return _ready(fds)
+
+    def tcgetattr(self, fd):
+        return tty.tcgetattr(fd)
+
+    def tcsetattr(self, fd, when, mode):
+        tty.tcsetattr(fd, when, mode)
+
+    def tcgetwinsize(self, fd):
+        return tty.tcgetwinsize(fd)
+
+    def waitpid(self, pid, options):
+        return os.waitpid(pid, options)
+
+_os_backend = OSBackend()
+
+# Loopback descriptors and pids start where real ones cannot: Linux
+# caps RLIMIT_NOFILE at 2**20 and pid_max at 2**22.
+_LOOPBACK_FD = 1 << 20
+_LOOPBACK_PID = 1 << 22
+
+# Longest canonical line, as in the Linux n_tty line discipline.
+_MAX_CANON = 4096
+
+def _sane_mode():
+    """Termios of a freshly opened pty, as stty sane would leave it."""
+    cc = [b"\0"] * tty.NCCS
+    for i, c in ((tty.VINTR, 0x03), (tty.VQUIT, 0x1c), (tty.VERASE, 0x7f),
+                 (tty.VKILL, 0x15), (tty.VEOF, 0x04), (tty.VSTART, 0x11),
+                 (tty.VSTOP, 0x13), (tty.VSUSP, 0x1a)):
+        cc[i] = bytes([c])
+    return [tty.BRKINT | tty.ICRNL | tty.IXON,
+            tty.OPOST | tty.ONLCR,
+            tty.CREAD | tty.CS8 | tty.HUPCL,
+            (tty.ISIG | tty.ICANON | tty.IEXTEN | tty.ECHO | tty.ECHOE |
+             tty.ECHOK | getattr(tty, "ECHOCTL", 0) |
+             getattr(tty, "ECHOKE", 0)),
+            tty.B38400, tty.B38400, cc]
+
+def _cc(mode, i):
+    """Control character i of mode as an int; None if disabled."""
+    c = mode[tty.CC][i]
+    if isinstance(c, bytes):
+        c = c[0]
+    # _POSIX_VDISABLE is 0 on Linux, 0xff on the BSDs.
+    return None if c in (0, 0xff) else c
+
+class _Pipe:
+    __slots__ = ("data", "reader", "writer")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.reader = self.writer = True
+
+class _Pty:
+    __slots__ = ("mode", "winsz", "input", "line", "output", "master",
+                 "slaves", "signals")
+
+    def __init__(self, mode, winsz):
+        self.mode = mode
+        self.winsz = winsz
+        self.input = deque()        # what the slave may read; b"" is EOF
+        self.line = bytearray()     # the canonical line being edited
+        self.output = bytearray()   # what the master may read
+        self.master = True
+        self.slaves = 1
+        self.signals = []
+
+class LoopbackBackend:
+    """LoopbackBackend(bsd=None, programs=None)
+    An in-process stand-in for OSBackend: ptys, pipes and children are
+    emulated, so that relay logic runs deterministically and without
+    forking. Input written to a master passes through a line discipline
+    honouring ICRNL, INLCR, IGNCR, ISTRIP, ICANON (VERASE, VKILL, VEOF,
+    VEOL), ECHO, ECHOE, ECHOK, ECHOKE, ECHONL, ECHOCTL and ISIG (VINTR,
+    VQUIT, VSUSP, recorded by signals()); output written to a slave
+    honours OPOST and ONLCR. VMIN and VTIME are not emulated.
+
+    Nothing ever blocks: a read with no data raises BlockingIOError,
+    and a select() or waitpid() that would wait forever raises
+    OSError(EDEADLK). Once a master has no slave and no output left,
+    reading it raises OSError(EIO) as on Linux, or returns b"" as on
+    the BSDs if bsd is true; bsd defaults to the host's behaviour.
+
+    stdin_fd and stdout_fd, the standard input and output of spawn()
+    and _copy(), are loopback pipes; write the former's other end,
+    stdin, and read the latter's, stdout. The commands spawn() can run
+    are those in the dict programs, see exec()."""
+
+    def __init__(self, bsd=None, programs=None):
+        if bsd is None:
+            bsd = not sys.platform.startswith("linux")
+        self.bsd = bsd
+        self.programs = dict(programs or {})
+        self._fds = {}
+        self._children = {}
+        self._next_fd = _LOOPBACK_FD
+        self._next_pid = _LOOPBACK_PID
+        self.stdin_fd, self.stdin = self.pipe()
+        self.stdout, self.stdout_fd = self.pipe()
+
+    def _new_fd(self, obj, end):
+        fd = self._next_fd
+        self._next_fd += 1
+        self._fds[fd] = obj, end
+        return fd
+
+    def _get(self, fd, ends=None):
+        try:
+            obj, end = self._fds[fd]
+        except KeyError:
+            raise OSError(errno.EBADF, os.strerror(errno.EBADF)) from None
+        if ends is not None and end not in ends:
+            raise tty.error(errno.ENOTTY, os.strerror(errno.ENOTTY))
+        return obj, end
+
+    def pipe(self):
+        """pipe() -> (read_fd, write_fd)"""
+        p = _Pipe()
+        return self._new_fd(p, "r"), self._new_fd(p, "w")
+
+    def openpty(self, mode=None, winsz=None):
+        """openpty() -> (master_fd, slave_fd)"""
+        if mode:
+            mode = list(mode)
+            mode[tty.CC] = list(mode[tty.CC])
+        else:
+            mode = _sane_mode()
+        t = _Pty(mode, tuple(winsz) if winsz else (24, 80))
+        return self._new_fd(t, "master"), self._new_fd(t, "slave")
+
+    def fork(self, mode=None, winsz=None, child=None):
+        """fork() -> (pid, master_fd)
+        Start a virtual child on a new pty. The child is the callable
+        child(slave_fd), if any, which select() and ready() call while
+        the slave is readable; it ends by calling exit()."""
+        master_fd, slave_fd = self.openpty(mode, winsz)
+        pid = self._next_pid
+        self._next_pid += 1
+        self._children[pid] = [slave_fd, child, None]
+        return pid, master_fd
+
+    def exec(self, argv, master_fd, slave_fd, saved_mask=None):
+        """Starts a virtual child on the pty of slave_fd, which becomes
+        the child's, as the child of fork() would be; returns its pid.
+        The child is program(argv, pid, slave_fd), program being
+        programs[argv[0]]. If there is no such program, the child exits
+        with status 127 at once, as upon a failed execlp()."""
+        pid = self._next_pid
+        self._next_pid += 1
+        program = self.programs.get(argv[0])
+        child = None
+        if program is not None:
+            child = lambda slave_fd: program(argv, pid, slave_fd)
+        self._children[pid] = [slave_fd, child, None]
+        if program is None:
+            self.exit(pid, 127)
+        return pid
+
+    def slave(self, pid):
+        """Returns the slave descriptor of the virtual child pid."""
+        return self._children[pid][0]
+
+    def exit(self, pid, code=0):
+        """Ends the virtual child pid with exit status code, closing
+        its slave."""
+        child = self._children[pid]
+        if child[2] is None:
+            if child[0] in self._fds:
+                self.close(child[0])
+            child[2] = (code & 0xff) << 8
+
+    def signals(self, fd):
+        """Returns the list of signals the line discipline of the pty of
+        fd has generated for the foreground process group so far."""
+        return self._get(fd, ("master", "slave"))[0].signals
+
+    def _input(self, t, data):
+        """Line discipline: input written to the master."""
+        iflag, _, _, lflag = t.mode[:4]
+        mode = t.mode
+        sigs = {}
+        if lflag & tty.ISIG:
+            for i, sig in ((tty.VINTR, signal.SIGINT),
+                           (tty.VQUIT, signal.SIGQUIT),
+                           (tty.VSUSP, signal.SIGTSTP)):
+                sigs[_cc(mode, i)] = sig
+        canon = lflag & tty.ICANON
+        erase, kill, eof, eol = (_cc(mode, i) for i in
+                                 (tty.VERASE, tty.VKILL, tty.VEOF, tty.VEOL))
+        echo = lflag & tty.ECHO
+        ctl = lflag & getattr(tty, "ECHOCTL", 0)
+
+        def echoed(c):
+            if ctl and (c < 0x20 and c not in (0x09, 0x0a) or c == 0x7f):
+                return bytes((0x5e, c ^ 0x40))
+            return bytes((c,))
+
+        out = bytearray()
+        raw = bytearray()
+        for c in data:
+            if iflag & tty.ISTRIP:
+                c &= 0x7f
+            if c == 0x0d:
+                if iflag & tty.IGNCR:
+                    continue
+                if iflag & tty.ICRNL:
+                    c = 0x0a
+            elif c == 0x0a and iflag & tty.INLCR:
+                c = 0x0d
+            sig = sigs.get(c)
+            if sig:
+                if not lflag & tty.NOFLSH:
+                    t.input.clear()
+                    t.line.clear()
+                    raw.clear()
+                t.signals.append(sig)
+                if echo:
+                    out += echoed(c)
+                continue
+            if canon:
+                if c == erase:
+                    if t.line:
+                        t.line.pop()
+                        if echo:
+                            out += b"\b \b" if lflag & tty.ECHOE else echoed(c)
+                    continue
+                if c == kill:
+                    if echo:
+                        if lflag & getattr(tty, "ECHOKE", 0):
+                            out += b"\b \b" * len(t.line)
+                        else:
+                            out += echoed(c)
+                            if lflag & tty.ECHOK:
+                                out += b"\n"
+                    t.line.clear()
+                    continue
+                if c == eof:
+                    t.input.append(bytes(t.line))
+                    t.line.clear()
+                    continue
+                if c == 0x0a or c == eol:
+                    t.line.append(c)
+                    t.input.append(bytes(t.line))
+                    t.line.clear()
+                    if echo or lflag & tty.ECHONL:
+                        out += echoed(c)
+                    continue
+                if len(t.line) >= _MAX_CANON - 1:
+                    continue
+                t.line.append(c)
+            else:
+                raw.append(c)
+            if echo:
+                out += echoed(c)
+        if raw:
+            t.input.append(bytes(raw))
+        t.output += self._opost(t, out)
+
+    def _opost(self, t, data):
+        """Output processing: output written to the slave, and echo."""
+        oflag = t.mode[tty.OFLAG]
+        if oflag & tty.OPOST and oflag & tty.ONLCR:
+            return bytes(data).replace(b"\n", b"\r\n")
+        return data
+
+    def _readable(self, fd):
+        obj, end = self._fds[fd]
+        if end == "r":
+            return bool(obj.data) or not obj.writer
+        if end == "master":
+            return bool(obj.output) or not obj.slaves
+        if end == "slave":
+            return bool(obj.input) or not obj.master
+        return False
+
+    def _run(self):
+        """Lets each virtual child with something to read run."""
+        for slave_fd, child, status in list(self._children.values()):
+            if (child is not None and status is None and
+                    slave_fd in self._fds and self._readable(slave_fd)):
+                child(slave_fd)
+
+    def read(self, fd, n=1024):
+        obj, end = self._get(fd)
+        if end == "r":
+            buf = obj.data
+            if not buf and obj.writer:
+                raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        elif end == "master":
+            buf = obj.output
+            if not buf and not obj.slaves:
+                if self.bsd:
+                    return b""
+                raise OSError(errno.EIO, os.strerror(errno.EIO))
+            if not buf:
+                raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        elif end == "slave":
+            if not obj.master:
+                return b""
+            if not obj.input:
+                raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+            if obj.mode[tty.LFLAG] & tty.ICANON:
+                # One line, or what fits of it, per read.
+                data = obj.input.popleft()
+                if len(data) > n:
+                    obj.input.appendleft(data[n:])
+                return data[:n]
+            data = b"".join(obj.input)
+            obj.input.clear()
+            if len(data) > n:
+                obj.input.append(data[n:])
+            return data[:n]
+        else:
+            raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+        data = bytes(buf[:n])
+        del buf[:n]
+        return data
+
+    def write(self, fd, data):
+        obj, end = self._get(fd)
+        if end == "w":
+            if not obj.reader:
+                raise BrokenPipeError(errno.EPIPE, os.strerror(errno.EPIPE))
+            obj.data += data
+        elif end == "master":
+            self._input(obj, data)
+        elif end == "slave":
+            if not obj.master:
+                raise OSError(errno.EIO, os.strerror(errno.EIO))
+            obj.output += self._opost(obj, data)
+        else:
+            raise OSError(errno.EBADF, os.strerror(errno.EBADF))
+        return len(data)
+
+    def close(self, fd):
+        obj, end = self._get(fd)
+        del self._fds[fd]
+        if end == "r":
+            obj.reader = False
+        elif end == "w":
+            obj.writer = False
+        elif end == "master":
+            obj.master = False
+            obj.input.clear()
+            obj.line.clear()
+            if obj.slaves:
+                obj.signals.append(signal.SIGHUP)
+        else:
+            obj.slaves -= 1
+
+    def select(self, rlist, wlist, xlist, timeout=None):
+        for fd in (*rlist, *wlist, *xlist):
+            self._get(fd)
+        self._run()
+        rfds = [fd for fd in rlist if self._readable(fd)]
+        wfds = [fd for fd in wlist if self._fds[fd][1] != "r"]
+        if not rfds and not wfds and timeout is None:
+            raise OSError(errno.EDEADLK, "select() would block forever")
+        return rfds, wfds, []
+
+    def ready(self, fds):
+        return self.select(fds, [], [], 0)[0]
+
+    def tcgetattr(self, fd):
+        mode = list(self._get(fd, ("master", "slave"))[0].mode)
+        mode[tty.CC] = list(mode[tty.CC])
+        return mode
+
+    def tcsetattr(self, fd, when, mode):
+        t = self._get(fd, ("master", "slave"))[0]
+        if when == tty.TCSAFLUSH:
+            t.input.clear()
+            t.line.clear()
+        elif (t.mode[tty.LFLAG] & tty.ICANON and
+              not mode[tty.LFLAG] & tty.ICANON and t.line):
+            # The partial line becomes readable.
+            t.input.append(bytes(t.line))
+            t.line.clear()
+        t.mode = list(mode)
+        t.mode[tty.CC] = list(mode[tty.CC])
+
+    def tcgetwinsize(self, fd):
+        return self._get(fd, ("master", "slave"))[0].winsz
+
+    def tcsetwinsize(self, fd, winsz):
+        t = self._get(fd, ("master", "slave"))[0]
+        winsz = tuple(winsz)
+        if winsz != t.winsz:
+            t.winsz = winsz
+            t.signals.append(signal.SIGWINCH)
+
+    def waitpid(self, pid, options):
+        child = self._children.get(pid)
+        if child is None:
+            raise ChildProcessError(errno.ECHILD, os.strerror(errno.ECHILD))
+        if child[2] is None:
+            if options & os.WNOHANG:
+                return 0, 0
+            raise OSError(errno.EDEADLK, "waitpid() would block forever")
+        del self._children[pid]
+        return pid, child[2]
+
+# POSIX.1-2017 <limits.h>: minimum acceptable value of MAX_INPUT.
+_POSIX_MAX_INPUT = 255
+
+PASTE_START = b"\x1b[200~"
+PASTE_END = b"\x1b[201~"
+
+# DECSET/DECRST 2004; sent by applications to turn bracketed paste on/off.
+_PASTE_MODE_RE = re.compile(rb"\x1b\[\?2004([hl])")
+_PASTE_MODE_LEN = len(b"\x1b[?2004h")
+
+class Feeder:
+    """Writes bulk input to a pty master without overrunning the line
+    discipline of the slave. Pending input is handed out in pieces that
+    suit the slave's current termios: in canonical mode, whole lines
+    adding up to at most MAX_INPUT bytes; otherwise everything at once.
+    If the application has turned on bracketed paste mode, which
+    observe() keeps track of, the input is sent as a single paste.
+    If slave_fd is given, canonical input is also held back until the
+    slave's input queue has room for it."""
+
+    def __init__(self, master_fd, slave_fd=None):
+        self.master_fd = master_fd
+        self.slave_fd = slave_fd
+        self.paste = False
+        try:
+            self.max_input = os.fpathconf(master_fd, "PC_MAX_INPUT")
+        except (OSError, ValueError):
+            self.max_input = -1
+        if self.max_input <= 0:
+            self.max_input = _POSIX_MAX_INPUT
+        self._data = memoryview(b"")
+        self._chunk = memoryview(b"")
+        self._tail = b""
+
+    def feed(self, data):
+        """Queues data for writing."""
+        if self._data:
+            data = bytes(self._data) + data
+        self._data = memoryview(bytes(data))
+
+    def pending(self):
+        """Returns True if there is input left to write."""
+        return bool(self._chunk or self._data)
+
+    def observe(self, data):
+        """Keeps track of bracketed paste mode; data is output read from
+        the pty master."""
+        head = self._tail + bytes(data[:_PASTE_MODE_LEN - 1])
+        for buf in (head, data):
+            match = None
+            for match in _PASTE_MODE_RE.finditer(buf):
+                pass
+            if match:
+                self.paste = match.group(1) == b"h"
+        self._tail = (self._tail + bytes(data[-(_PASTE_MODE_LEN - 1):]))[
+            -(_PASTE_MODE_LEN - 1):]
+
+    def _inq(self):
+        """Returns the number of bytes waiting in the slave's input queue."""
+        return unpack("i", ioctl(self.slave_fd, tty.FIONREAD, b"\0" * 4))[0]
+
+    def _next_chunk(self):
+        """Takes the next piece of pending input. Returns an empty
+        memoryview if the slave has no room for it yet."""
+        data = self._data
+        if self.paste:
+            # Keep the input from ending the paste early.
+            self._data = memoryview(b"")
+            return memoryview(PASTE_START +
+                              bytes(data).replace(PASTE_END, b"") + PASTE_END)
+
+        mode = tty.tcgetattr(self.master_fd)
+        if not mode[tty.LFLAG] & tty.ICANON:
+            self._data = memoryview(b"")
+            return data
+
+        room = self.max_input
+        if self.slave_fd is not None and hasattr(tty, "FIONREAD"):
+            # Input queued while the slave was not canonical can leave
+            # more than MAX_INPUT waiting.
+            room = max(0, room - self._inq())
+            if not room:
+                return data[:0]
+        end = bytes(data[:room]).rfind(b"\n") + 1
+        if not end:
+            if room < self.max_input:
+                # Wait for the queue to drain rather than split a line.
+                return data[:0]
+            # A line longer than MAX_INPUT cannot be delivered intact in
+            # canonical mode anyway, so it is simply cut.
+            end = room
+        self._data = data[end:]
+        return data[:end]
+
+    def send(self):
+        """Writes as much pending input as the pty master accepts without
+        blocking. Returns the number of bytes written."""
+        if not self._chunk:
+            self._chunk = self._next_chunk()
+            if not self._chunk:
+                return 0
+        try:
+            n = os.write(self.master_fd, self._chunk)
+        except BlockingIOError:
+            n = 0
+        self._chunk = self._chunk[n:]
+        return n
+
+    def write(self, data, timeout=None):
+        """Writes data to the pty master, waiting for it to be writable
+        between pieces. The master must be in non-blocking mode. Returns
+        the number of bytes not written when timeout seconds run out."""
+        self.feed(data)
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        delay = 0.001
+        while self.pending():
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+            if not select([], [self.master_fd], [], wait)[1]:
+                continue
+            if self.send():
+                delay = 0.001
+            else:
+                # Writable but nothing to send: the slave's input queue
+                # is full; wait for the child to read some of it.
+                if wait is not None:
+                    delay = min(delay, wait)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        return len(self._chunk) + len(self._data)
+
+def _eof(mode, data):
+    """Returns what has to follow data on the pty master for a read() on
+    the slave to return EOF once data has been consumed: VEOF, twice if
+    data ends in the middle of a line. Returns b"" if the slave is not
+    in canonical mode, since there is no EOF character then."""
+    if not mode[tty.LFLAG] & tty.ICANON:
+        return b""
+    eof = mode[tty.CC][tty.VEOF]
+    if data.endswith(b"\n"):
+        return eof
+    return eof * 2
+
+def _run_start(argv, input, timeout, mode, winsz):
+    """Common setup of run() and stream(). Returns (argv, pid,
+    master_fd, Feeder of input, deadline/None)."""
+    if type(argv) == type(''):
+        argv = (argv,)
+    sys.audit('pty.spawn', argv)
+
+    master_fd, slave_fd = openpty(mode, winsz, nonblock=True)
+    feeder = Feeder(master_fd)
+    if input:
+        data = bytes(input)
+        feeder.feed(data + _eof(tty.tcgetattr(slave_fd), data))
+
+    pid = _exec(argv, master_fd, slave_fd)
+
+    deadline = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+
+    return argv, pid, master_fd, feeder, deadline
+
+def _pump(master_fd, feeder, deadline, read):
+    """I/O loop of run() and stream(). Writes the input of feeder to
+    master_fd whenever it is writable and yields read(master_fd) whenever
+    it is readable, until read() signals EOF (see _copy()); read() is to
+    pass the output to feeder.observe() while input is pending. Raises
+    TimeoutError once deadline, a time.monotonic() value, has passed."""
+    timeout = None
+    while True:
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError
+        wfds = [master_fd] if feeder.pending() else []
+        rfds, wfds = select([master_fd], wfds, [], timeout)[:2]
+        if wfds:
+            feeder.send()
+        if rfds:
+            try:
+                got = read(master_fd)
+            except BlockingIOError:
+                continue
+            except OSError:
+                got = None
+            if not got:
+                return
+            yield got
+
+def _reap(pid):
+    """Kills the process group of an unfinished child and reaps it."""
+    _killpg(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def run(argv, input=None, timeout=None, mode=None, winsz=None, bufsize=65536):
+    """run(argv) -> (status, output)
+    Run a process on a new pty without involving the current terminal.
+    input is written to the pty master through a Feeder as the child
+    consumes it and is followed by EOF if the slave is in canonical mode. The child's
+    output, including any echo of input, is collected in a buffer that
+    starts at bufsize bytes and doubles when full. Returns the exit
+    status value from os.waitpid() and the output. If timeout seconds
+    pass first, the child's process group is killed and
+    subprocess.TimeoutExpired is raised."""
+    argv, pid, master_fd, feeder, deadline = _run_start(argv, input, timeout,
+                                                        mode, winsz)
+    buf = bytearray(bufsize or 1)
+    n = 0
+
+    def readinto(fd):
+        nonlocal n
+        if n == len(buf):
+            buf.extend(bytes(n))
+        got = os.readv(fd, [memoryview(buf)[n:]])
+        if feeder.pending():
+            feeder.observe(memoryview(buf)[n:n + got])
+        n += got
+        return got
+
+    try:
+        for _ in _pump(master_fd, feeder, deadline, readinto):
+            pass
+        # Reap before closing the master: the child may still be
+        # exiting after closing the slave, and closing the master
+        # would hang up its session.
+        status = os.waitpid(pid, 0)[1]
+    except TimeoutError:
+        _reap(pid)
+        from subprocess import TimeoutExpired
+        raise TimeoutExpired(argv, timeout, output=bytes(buf[:n])) from None
+    except BaseException:
+        _reap(pid)
+        raise
+    finally:
+        os.close(master_fd)
+
+    del buf[n:]
+    return status, bytes(buf)
+
+def stream(argv, input=None, timeout=None, mode=None, winsz=None, bufsize=65536):
+    """stream(argv) -> generator of output chunks
+    Like run(), but yields the child's output as it arrives, in chunks of
+    at most bufsize bytes. The exit status value is the return value of
+    the generator, so it can be obtained with "yield from". Closing the
+    generator early kills the child's process group."""
+    argv, pid, master_fd, feeder, deadline = _run_start(argv, input, timeout,
+                                                        mode, winsz)
+
+    def read(fd):
+        data = os.read(fd, bufsize)
+        if feeder.pending():
+            feeder.observe(data)
+        return data
+
+    try:
+        yield from _pump(master_fd, feeder, deadline, read)
+        # See run().
+        return os.waitpid(pid, 0)[1]
+    except TimeoutError:
+        _reap(pid)
+        from subprocess import TimeoutExpired
+        raise TimeoutExpired(argv, timeout) from None
+    except BaseException:
+        _reap(pid)
+        raise
+    finally:
+        os.close(master_fd)
+
+class Reaper:
+    """Reaps children in a background thread, so that nobody has to block
+    in os.waitpid(). Children are watched through pidfds where these are
+    available (Linux); elsewhere the thread wakes up upon SIGCHLD if the
+    Reaper was created in the main thread, and every interval seconds
+    otherwise. Exit status and resource usage come from os.wait4()."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._children = {}  # pid -> (future, pidfd/None)
+        self._polled = 0  # children without a pidfd
+        self._closed = False
+        self._rsock, self._wsock = socket.socketpair()
+        self._wsock.setblocking(False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._rsock, selectors.EVENT_READ)
+        self._bkh = None
+        if not hasattr(os, "pidfd_open") and \
+           threading.current_thread() is threading.main_thread():
+            self._bkh = signal.signal(signal.SIGCHLD, self._hchld)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _hchld(self, signum, frame):
+        """SIGCHLD handler."""
+        self._wake()
+        if callable(self._bkh):
+            self._bkh(signum, frame)
+
+    def _wake(self):
+        try:
+            self._wsock.send(b"\0")
+        except OSError:
+            pass
+
+    def watch(self, pid, callback=None):
+        """Returns a concurrent.futures.Future that gets the result
+        (status, rusage) once child pid has exited, status being the exit
+        status value as from os.waitpid(). callback, if given, is called
+        with the future from the reaper thread."""
+        from concurrent.futures import Future
+        future = Future()
+        if callback:
+            future.add_done_callback(callback)
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(pid)
+            except ProcessLookupError as e:
+                future.set_exception(ChildProcessError(e.errno, e.strerror))
+                return future
+            except OSError:
+                pass # kernel without pidfd support; poll
+        with self._lock:
+            self._children[pid] = (future, pidfd)
+            if pidfd is not None:
+                # The selector picks it up without waking the thread.
+                self._selector.register(pidfd, selectors.EVENT_READ, pid)
+                return future
+            self._polled += 1
+        self._wake()
+        return future
+
+    def _run(self):
+        """Reaper thread loop."""
+        while not self._closed:
+            polling = self._polled > 0
+            events = self._selector.select(self.interval if polling
+                                           else None)
+            candidates = []
+            for key, mask in events:
+                if key.data is None:
+                    self._rsock.recv(4096)
+                else:
+                    candidates.append(key.data)
+            if polling:
+                with self._lock:
+                    # Cannot tell which one exited.
+                    candidates += [pid for pid, (future, pidfd)
+                                   in self._children.items() if pidfd is None]
+            for pid in candidates:
+                self._reap(pid)
+
+    def _reap(self, pid):
+        try:
+            rpid, status, rusage = os.wait4(pid, os.WNOHANG)
+        except ChildProcessError as e:
+            rpid, result = pid, e
+        else:
+            result = (status, rusage)
+        if not rpid:
+            return
+        with self._lock:
+            future, pidfd = self._children.pop(pid)
+            if pidfd is not None:
+                self._selector.unregister(pidfd)
+            else:
+                self._polled -= 1
+        if pidfd is not None:
+            os.close(pidfd)
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def close(self):
+        """Stops the reaper thread. Children not yet reaped are left
+        alone, and their futures are cancelled."""
+        self._closed = True
+        self._wake()
+        self._thread.join()
+        if self._bkh is not None:
+            signal.signal(signal.SIGCHLD, self._bkh)
+        for future, pidfd in self._children.values():
+            if pidfd is not None:
+                os.close(pidfd)
+            future.cancel()
+        self._children.clear()
+        self._selector.close()
+        self._rsock.close()
+        self._wsock.close()
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+def reaper():
+    """Returns the process-wide Reaper, creating it if need be."""
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper()
+        return _reaper
+
+def _reaper_after_fork():
+    """The reaper thread does not survive fork()."""
+    global _reaper, _reaper_lock
+    _reaper = None
+    _reaper_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reaper_after_fork)
+
+RunResult = namedtuple("RunResult", "argv status output elapsed timed_out "
+                                    "rusage")
+RunResult.__doc__ = """Outcome of one command of run_many(). status is
+the exit status value from os.waitpid(), elapsed is the wall-clock time
+in seconds, timed_out tells if the command was killed upon a timeout, and
+rusage is its resource usage as from os.wait4()."""
+
+class _Job:
+    """A command being run by run_many()."""
+    __slots__ = ("index", "argv", "pid", "master_fd", "output", "start",
+                 "watchdog", "limit", "paused", "future", "eof")
+
+def _job_start(index, argv, master_fd, slave_fd, wheel, timeout, idle, grace,
+               limit, wake):
+    """Starts a command of run_many() on the given pty pair, with its
+    timeouts on wheel. wake is called from the reaper thread once the
+    command has exited. Returns a _Job."""
+    job = _Job()
+    job.index = index
+    job.argv = argv
+    job.output = bytearray()
+    job.limit = limit() if limit else None
+    job.paused = False
+    job.eof = False
+    job.start = time.monotonic()
+    job.pid = _exec(argv, master_fd, slave_fd)
+    job.master_fd = master_fd
+    job.future = reaper().watch(job.pid, wake)
+    job.watchdog = None
+    if timeout is not None or idle is not None:
+        job.watchdog = Watchdog(wheel, job.pid, idle, timeout, grace)
+    return job
+
+def _job_finish(job):
+    """Closes the master of a command of run_many() that has been reaped.
+    Returns a RunResult."""
+    # See run() for why the master is closed only after reaping.
+    status, rusage = job.future.result()
+    os.close(job.master_fd)
+    if job.limit is not None:
+        job.output += job.limit.flush()
+    timed_out = False
+    if job.watchdog is not None:
+        job.watchdog.stop()
+        timed_out = job.watchdog.expired is not None
+    return RunResult(job.argv, status, bytes(job.output),
+                     time.monotonic() - job.start, timed_out, rusage)
+
+def run_many(commands, jobs=None, timeout=None, fail_fast=False, mode=None,
+             winsz=None, bufsize=65536, limit=None, idle=None, grace=None):
+    """run_many(commands) -> list of RunResult/None
+    Run each command of commands, an iterable of argv, on its own pty,
+    with at most jobs (default: number of CPUs) of them at a time. The
+    output of all running commands is collected in a single event loop,
+    and the commands are reaped by the process-wide Reaper. A command
+    still running after timeout seconds, or that has written nothing for
+    idle seconds, has its process group killed, after SIGHUP and SIGTERM
+    grace seconds apart if grace is given (see Watchdog); the timeouts
+    of all commands share one TimerWheel.
+    If fail_fast is true, the first command that does not exit with
+    status 0 causes the running ones to be killed and the rest not to be
+    started. If limit, a callable returning a RateLimit, is given, the
+    output of each command is subject to a RateLimit of its own.
+    Returns one RunResult per command, in order; the entry of a command
+    that was never started is None."""
+    commands = [(argv,) if type(argv) == type('') else tuple(argv)
+                for argv in commands]
+    for argv in commands:
+        sys.audit('pty.spawn', argv)
+    jobs = jobs or os.cpu_count() or 1
+
+    results = [None] * len(commands)
+    pending = iter(enumerate(commands))
+    running = {}
+    failed = False
+    wheel = TimerWheel()
+    sel = selectors.DefaultSelector()
+    rsock, wsock = socket.socketpair()
+    wsock.setblocking(False)
+    sel.register(rsock, selectors.EVENT_READ)
+
+    def wake(future):
+        try:
+            wsock.send(b"\0")
+        except OSError:
+            pass
+
+    def stop(job, kill=False):
+        """Stops reading from a command; kills it if kill is true."""
+        if not job.eof and not job.paused:
+            sel.unregister(job.master_fd)
+        job.eof = True
+        if kill:
+            _killpg(job.pid, signal.SIGKILL)
+
+    def collect():
+        """Records the results of commands that have been reaped."""
+        nonlocal failed
+        for job in list(running.values()):
+            if job.eof and job.future.done():
+                del running[job.master_fd]
+                result = results[job.index] = _job_finish(job)
+                if fail_fast and result.status != 0:
+                    failed = True
+
+    try:
+        while True:
+            collect()
+            if failed:
+                for job in running.values():
+                    stop(job, kill=True)
+            batch = []
+            while not failed and len(running) + len(batch) < jobs:
+                try:
+                    batch.append(next(pending))
+                except StopIteration:
+                    break
+            pairs = openpty_many(len(batch), mode, winsz)
+            for (index, argv), (master_fd, slave_fd) in zip(batch, pairs):
+                job = _job_start(index, argv, master_fd, slave_fd, wheel,
+                                 timeout, idle, grace, limit, wake)
+                running[job.master_fd] = job
+                sel.register(job.master_fd, selectors.EVENT_READ, job)
+            if not running:
+                break
+
+            wait = wheel.timeout()
+            if limit is not None:
+                # Commands over budget are not read from until they
+                # are within it again.
+                for job in running.values():
+                    if job.eof:
+                        continue
+                    delay = job.limit.delay()
+                    if delay and not job.paused:
+                        sel.unregister(job.master_fd)
+                    elif not delay and job.paused:
+                        sel.register(job.master_fd, selectors.EVENT_READ, job)
+                    job.paused = bool(delay)
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+            for key, _ in sel.select(wait):
+                job = key.data
+                if job is None:
+                    rsock.recv(4096)
+                    continue
+                try:
+                    data = os.read(job.master_fd, bufsize)
+                except OSError:
+                    data = b""
+                if not data:
+                    stop(job)
+                    continue
+                if job.watchdog is not None:
+                    job.watchdog.activity()
+                if job.limit is not None:
+                    job.output += job.limit.admit(data)
+                else:
+                    job.output += data
+            wheel.advance()
+    finally:
+        for job in running.values():
+            if job.watchdog is not None:
+                job.watchdog.stop()
+            _killpg(job.pid, signal.SIGKILL)
+            job.future.result()
+            os.close(job.master_fd)
+        sel.close()
+        rsock.close()
+        wsock.close()
+
+    return results
+
+# Longest OSC/DCS/SOS/PM/APC body that is recognized as such; longer
+# ones are treated as garbage. This bounds what AnsiStripper holds back.
+_STRING_MAX = 4096
+
+# Escape sequences (ECMA-48) and C0 controls other than TAB, LF and CR.
+# An ESC that does not start a well-formed sequence is removed alone.
+_ANSI_RE = re.compile(rb"""
+      \x1b\[ [\x30-\x3f]* [\x20-\x2f]* [\x40-\x7e]           # CSI
+    | \x1b[\]PX^_] [^\x07\x1b]{0,%d} (?:\x07|\x1b\\)         # OSC etc.
+    | \x1b [\x20-\x2f]* [\x30-\x7e]                          # other
+    | [\x00-\x08\x0b\x0c\x0e-\x1f\x7f]                       # controls
+""" % _STRING_MAX, re.VERBOSE)
+
+# What may still grow into a match of _ANSI_RE with more data.
+_ANSI_PARTIAL_RE = re.compile(rb"""
+    \x1b (?: \[ [\x30-\x3f]* [\x20-\x2f]*
+           | [\]PX^_] [^\x07\x1b]{0,%d} \x1b?
+           | [\x20-\x2f]* )
+""" % _STRING_MAX, re.VERBOSE)
+
+# The last ESC of a buffer, or of its first endpos bytes.
+_LAST_ESC_RE = re.compile(rb"\x1b[^\x1b]*\Z")
+
+def _join(data, tail):
+    """Concatenates two outputs of a pipeline stage."""
+    if not data:
+        return tail
+    if not tail:
+        return data
+    if isinstance(data, str):
+        return data + tail
+    return bytes(data) + tail
+
+class AnsiStripper:
+    """Pipeline stage that removes escape sequences and all control
+    characters but TAB, LF, and CR. A sequence split across chunks is
+    held back until it is complete, so the result does not depend on how
+    the output is chunked. Returns its input unchanged, without copying,
+    if there is nothing to remove and nothing was held back."""
+
+    def __init__(self):
+        self._tail = b""
+
+    def _split(self, data):
+        """Returns the length of data that can be processed now."""
+        end = len(data)
+        # Nothing that may grow is longer than this. The regular
+        # expressions take the memoryview as it is, without a copy.
+        start = max(0, end - _STRING_MAX - 4)
+        match = _LAST_ESC_RE.search(data, start)
+        if not match:
+            return end
+        i = match.start()
+        match = _LAST_ESC_RE.search(data, start, i)
+        if match and _ANSI_PARTIAL_RE.fullmatch(data, match.start()):
+            return match.start()
+        if _ANSI_PARTIAL_RE.fullmatch(data, i):
+            return i
+        return end
+
+    def _strip(self, data):
+        match = _ANSI_RE.search(data)
+        if not match:
+            return data
+        i = match.start()
+        return b"".join((data[:i], _ANSI_RE.sub(b"", data[i:])))
+
+    def __call__(self, data):
+        if self._tail:
+            data = self._tail + data
+            self._tail = b""
+        end = self._split(data)
+        if end < len(data):
+            self._tail = bytes(data[end:])
+            data = data[:end]
+        return self._strip(data)
+
+    def flush(self):
+        data, self._tail = self._tail, b""
+        return self._strip(data)
+
+_NEWLINE_RE = re.compile(rb"\r+\n?")
+
+class NewlineNormalizer:
+    """Pipeline stage that turns CR LF, as written by a tty with ONLCR set,
+    and lone CR into LF. Trailing CRs of a chunk are held back until it is
+    known whether an LF follows them."""
+
+    def __init__(self):
+        self._tail = b""
+
+    def __call__(self, data):
+        if self._tail:
+            data = self._tail + data
+            self._tail = b""
+        if not _NEWLINE_RE.search(data):
+            return data
+        end = len(data)
+        while end and data[end - 1] == 0x0d:
+            end -= 1
+        self._tail = bytes(data[end:])
+        return _NEWLINE_RE.sub(b"\n", data[:end])
+
+    def flush(self):
+        data, self._tail = self._tail, b""
+        return _NEWLINE_RE.sub(b"\n", data)
+
+class Utf8Decoder:
+    """Pipeline stage that decodes UTF-8 into str. A character split
+    across chunks is decoded once all of it has arrived."""
+
+    def __init__(self, errors="replace"):
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors)
+
+    def __call__(self, data):
+        return self._decoder.decode(data)
+
+    def flush(self):
+        return self._decoder.decode(b"", True)
+
+class Redactor:
+    """Pipeline stage that replaces matches of pattern, a compiled regular
+    expression of bytes or str, with repl. The last window bytes or
+    characters of each chunk are held back so that a match split across
+    chunks is caught; matches are assumed to be shorter than window.
+    The bytes held back have to come out ahead of the next chunk, so
+    each chunk but the first is joined to them, once; beyond that, the
+    input is copied only where something matches."""
+
+    def __init__(self, pattern, repl=None, window=256):
+        self.pattern = pattern
+        if repl is None:
+            repl = b"[REDACTED]" if isinstance(pattern.pattern, bytes) \
+                   else "[REDACTED]"
+        self.repl = repl
+        self.window = window
+        self._tail = repl[:0]
+
+    def _redact(self, data, cut):
+        out = []
+        pos = 0
+        for match in self.pattern.finditer(data):
+            if match.end() > cut:
+                # May match differently with what comes next.
+                cut = min(cut, match.start())
+                break
+            out += (data[pos:match.start()], self.repl)
+            pos = match.end()
+        tail = data[cut:]
+        self._tail = tail if isinstance(tail, (bytes, str)) else bytes(tail)
+        if not out:
+            return data[:cut]
+        out.append(data[pos:cut])
+        return self.repl[:0].join(out)
+
+    def __call__(self, data):
+        if self._tail:
+            data = self._tail + data
+            if isinstance(data, bytes):
+                # So that what is returned is not copied again.
+                data = memoryview(data)
+        return self._redact(data, max(0, len(data) - self.window))
+
+    def flush(self):
+        data = self._tail
+        return self._redact(data, len(data)) if data else data
+
+class Compressor:
+    """Pipeline stage that compresses with zlib; str is encoded as UTF-8.
+    If sync is true, each chunk is flushed with Z_SYNC_FLUSH so that the
+    compressed stream can be decoded as it is written."""
+
+    def __init__(self, level=-1, wbits=zlib.MAX_WBITS, sync=False):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        self.sync = sync
+
+    def __call__(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        out = self._compressor.compress(data)
+        if self.sync:
+            out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return out
+
+    def flush(self):
+        return self._compressor.flush()
+
+class Pipeline:
+    """Chain of stages that transform output read from a pty master, each
+    a callable taking and returning a chunk, with a flush() method that
+    returns what it has held back. Chunks are passed as memoryviews; a
+    stage copies only if it changes the data. The output goes to sink if
+    given, and is returned by feed() and close() otherwise. If thread is
+    true, the stages and sink run in a worker thread, which requires
+    sink."""
+
+    def __init__(self, *stages, sink=None, thread=False):
+        if thread and sink is None:
+            raise ValueError("thread requires sink")
+        self.stages = stages
+        self.sink = sink
+        self._queue = None
+        self._error = None
+        if thread:
+            self._queue = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def _process(self, data):
+        for stage in self.stages:
+            data = stage(data)
+            if not data:
+                break
+        return data
+
+    def _output(self, data):
+        if self.sink is None:
+            return data
+        if data:
+            self.sink(data)
+
+    def _work(self):
+        """Worker thread loop."""
+        while (data := self._queue.get()) is not None:
+            if self._error is None:
+                try:
+                    self._output(self._process(memoryview(data)))
+                except BaseException as e:
+                    self._error = e
+
+    def feed(self, data):
+        """Passes a chunk through the stages."""
+        if self._error is not None:
+            raise self._error
+        if self._queue is not None:
+            # The caller may reuse its buffer.
+            self._queue.put(bytes(data))
+            return
+        return self._output(self._process(memoryview(data)))
+
+    def close(self):
+        """Flushes all stages, and stops the worker thread if any."""
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+        if self._error is not None:
+            raise self._error
+        data = b""
+        for stage in self.stages:
+            if data:
+                data = stage(memoryview(data) if isinstance(data, bytes)
+                             else data)
+            data = _join(data, stage.flush())
+        return self._output(data)
+
+    def reader(self, read=_read):
+        """Returns a master_read function for spawn() that passes what
+        read() returns through the pipeline as well."""
+        def master_read(fd):
+            data = read(fd)
+            if data:
+                self.feed(data)
+            return data
+        return master_read
+
+# Frames of the session protocol: a type byte and the payload length as
+# ">BI", then the payload.
+FRAME_DATA = 0      # bytes to or from the pty
+FRAME_RESIZE = 1    # ">HHHH": rows, columns, xpixel, ypixel
+FRAME_SIGNAL = 2    # ">i": signal for the process group of the session
+FRAME_EXIT = 3      # ">i": wait status of the session
+FRAME_ATTACH = 4    # b"stream", b"replay" or b"fd"
+FRAME_SCREEN = 5    # screen snapshot handed back by an fd client
+
+_FRAME_HEADER = ">BI"
+_FRAME_HEADER_LEN = 5
+
+def frame(type, payload=b""):
+    """frame(type, payload) -> bytes"""
+    return pack(_FRAME_HEADER, type, len(payload)) + payload
+
+class FrameReader:
+    """Splits a byte stream into frames."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self, data):
+        """Returns the (type, payload) frames completed by data."""
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        while len(buf) - pos >= _FRAME_HEADER_LEN:
+            type, n = unpack(_FRAME_HEADER, buf[pos:pos + _FRAME_HEADER_LEN])
+            end = pos + _FRAME_HEADER_LEN + n
+            if end > len(buf):
+                break
+            frames.append((type, bytes(buf[pos + _FRAME_HEADER_LEN:end])))
+            pos = end
+        del buf[:pos]
+        return frames
+
+def _control(type, payload, pid, master_fd):
+    """Carries out a RESIZE or SIGNAL frame from a client, for the session
+    of pid on master_fd. Returns (rows, cols) for a RESIZE and True for a
+    SIGNAL; None if the frame is malformed or cannot be carried out."""
+    try:
+        if type == FRAME_RESIZE and len(payload) == 8:
+            rows, cols = unpack(">HHHH", payload)[:2]
+            if tty.HAVE_WINSZ:
+                tty.tcsetwinsize(master_fd, (rows, cols))
+            return rows, cols
+        if type == FRAME_SIGNAL and len(payload) == 4:
+            _killpg(pid, unpack(">i", payload)[0])
+            return True
+    except (OSError, ValueError, tty.error):
+        pass
+    return None
+
+# Escape sequences as _Screen understands them, on decoded output.
+_SCREEN_RE = re.compile(r"""
+      \x1b\[ ([0-?]*) [ -/]* ([@-~])                  # CSI
+    | \x1b\] [^\x07\x1b]* (?:\x07|\x1b\\)             # OSC
+    | \x1b[PX^_] [^\x1b]* \x1b\\                      # DCS etc.
+    | \x1b [ -/]* ([0-OQ-WYZ\\`-~])                   # other
+    | ([\x00-\x1f\x7f])                               # controls
+    | ([^\x00-\x1f\x7f]+)                             # text
+""", re.VERBOSE)
+
+class _Screen:
+    """What a terminal of rows x cols would show: text and cursor, but no
+    attributes. snapshot() redraws it in a size that does not depend on
+    how much output there has been."""
+
+    def __init__(self, rows=24, cols=80):
+        # Terminals that do not know their size report 0 x 0.
+        self.rows = max(1, rows)
+        self.cols = max(1, cols)
+        self._decode = codecs.getincrementaldecoder("utf-8")("replace").decode
+        self._tail = ""
+        self.reset()
+
+    def reset(self):
+        self.grid = [[" "] * self.cols for _ in range(self.rows)]
+        self.y = self.x = 0
+        self.saved = (0, 0)
+
+    def resize(self, rows, cols):
+        rows = max(1, rows)
+        cols = max(1, cols)
+        for row in self.grid:
+            if cols > self.cols:
+                row += [" "] * (cols - self.cols)
+            else:
+                del row[cols:]
+        if rows < self.rows:
+            # Like terminals, keep the bottom rows.
+            drop = max(0, min(self.rows - rows, self.y + 1 - rows))
+            del self.grid[:drop]
+            del self.grid[rows:]
+            self.y -= drop
+        else:
+            self.grid += [[" "] * cols for _ in range(rows - self.rows)]
+        self.rows = rows
+        self.cols = cols
+        self.y = min(self.y, rows - 1)
+        self.x = min(self.x, cols)
+
+    def _linefeed(self):
+        if self.y == self.rows - 1:
+            del self.grid[0]
+            self.grid.append([" "] * self.cols)
+        else:
+            self.y += 1
+
+    def _text(self, s):
+        while s:
+            if self.x >= self.cols:
+                self.x = 0
+                self._linefeed()
+            n = self.cols - self.x
+            part, s = s[:n], s[n:]
+            self.grid[self.y][self.x:self.x + len(part)] = part
+            self.x += len(part)
+
+    def _erase(self, y, start, end):
+        self.grid[y][start:end] = [" "] * (end - start)
+
+    def _control(self, c):
+        if c == "\r":
+            self.x = 0
+        elif c in "\n\x0b\x0c":
+            self._linefeed()
+        elif c == "\b":
+            self.x = max(0, min(self.x, self.cols - 1) - 1)
+        elif c == "\t":
+            self.x = min((self.x // 8 + 1) * 8, self.cols - 1)
+
+    def _escape(self, c):
+        if c == "7":
+            self.saved = (self.y, self.x)
+        elif c == "8":
+            self.y, self.x = self.saved
+        elif c == "c":
+            self.reset()
+        elif c == "D":
+            self._linefeed()
+        elif c == "E":
+            self.x = 0
+            self._linefeed()
+        elif c == "M":
+            if self.y == 0:
+                self.grid.insert(0, [" "] * self.cols)
+                del self.grid[-1]
+            else:
+                self.y -= 1
+
+    def _csi(self, params, final):
+        if params.startswith("?"):
+            # Entering or leaving the alternate screen clears it.
+            if final in "hl" and {"47", "1047", "1049"} & \
+               set(params[1:].split(";")):
+                self.reset()
+            return
+        args = [int(p) if p.isdigit() else 0 for p in params.split(";")]
+        n = max(1, args[0])
+        rows, cols = self.rows, self.cols
+        x = min(self.x, cols - 1)
+        if final == "A":
+            self.y = max(0, self.y - n)
+        elif final in "Be":
+            self.y = min(rows - 1, self.y + n)
+        elif final in "Ca":
+            self.x = min(cols - 1, x + n)
+        elif final == "D":
+            self.x = max(0, x - n)
+        elif final == "E":
+            self.y, self.x = min(rows - 1, self.y + n), 0
+        elif final == "F":
+            self.y, self.x = max(0, self.y - n), 0
+        elif final in "G`":
+            self.x = min(n, cols) - 1
+        elif final == "d":
+            self.y = min(n, rows) - 1
+        elif final in "Hf":
+            self.y = min(n, rows) - 1
+            self.x = min(max(1, args[1]) if len(args) > 1 else 1, cols) - 1
+        elif final == "J":
+            if args[0] == 0:
+                self._erase(self.y, x, cols)
+                for y in range(self.y + 1, rows):
+                    self._erase(y, 0, cols)
+            elif args[0] == 1:
+                for y in range(self.y):
+                    self._erase(y, 0, cols)
+                self._erase(self.y, 0, x + 1)
+            else:
+                for y in range(rows):
+                    self._erase(y, 0, cols)
+        elif final == "K":
+            if args[0] == 0:
+                self._erase(self.y, x, cols)
+            elif args[0] == 1:
+                self._erase(self.y, 0, x + 1)
+            else:
+                self._erase(self.y, 0, cols)
+        elif final in "LM":
+            n = min(n, rows - self.y)
+            blank = [[" "] * cols for _ in range(n)]
+            if final == "L":
+                self.grid[self.y:self.y] = blank
+                del self.grid[rows:]
+            else:
+                del self.grid[self.y:self.y + n]
+                self.grid += blank
+        elif final in "@PX":
+            row = self.grid[self.y]
+            n = min(n, cols - x)
+            if final == "@":
+                row[x:x] = [" "] * n
+                del row[cols:]
+            elif final == "P":
+                del row[x:x + n]
+                row += [" "] * n
+            else:
+                self._erase(self.y, x, x + n)
+        elif final == "s":
+            self.saved = (self.y, self.x)
+        elif final == "u":
+            self.y, self.x = self.saved
+
+    def feed(self, data):
+        text = self._tail + self._decode(data)
+        self._tail = ""
+        i = text.rfind("\x1b")
+        if i >= 0 and len(text) - i < _STRING_MAX:
+            match = _SCREEN_RE.match(text, i)
+            if match is None or match.end() == i + 1:
+                # May yet become a sequence.
+                text, self._tail = text[:i], text[i:]
+        for match in _SCREEN_RE.finditer(text):
+            kind = match.lastindex
+            if kind == 5:
+                self._text(match.group(5))
+            elif kind == 4:
+                self._control(match.group(4))
+            elif kind == 3:
+                self._escape(match.group(3))
+            elif kind == 2:
+                self._csi(match.group(1), match.group(2))
+
+    def snapshot(self):
+        """Returns output that redraws the screen on a terminal."""
+        out = ["\x1b[0m\x1b[H\x1b[2J"]
+        for y, row in enumerate(self.grid):
+            line = "".join(row).rstrip(" ")
+            if line:
+                out.append("\x1b[%d;1H%s" % (y + 1, line))
+        out.append("\x1b[%d;%dH" % (self.y + 1, min(self.x, self.cols - 1) + 1))
+        return "".join(out).encode()
+
+class _Client:
+    __slots__ = ("sock", "reader", "out", "mode")
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.out = bytearray()
+        self.mode = None
+
+class Session:
+    """Session(argv, path, mode=None, winsz=None, replay=65536)
+    A detachable session: runs argv on a pty from fork(), and serves it
+    on the Unix socket path, to which clients attach() and from which
+    they detach at will. The session keeps the last replay bytes of
+    output and a model of the screen, so that an attaching client is
+    sent a snapshot of the screen whose size does not depend on how long
+    the session has run. Input is queued, and written to the master only
+    as fast as the pty takes it, so that a child not reading its input
+    holds up no one else.
+
+    A "stream" client is relayed through the session. An "fd" client is
+    sent the pty master itself with socket.send_fds(), and the session
+    stops reading the master until that client detaches and hands back
+    its screen; there is at most one fd client at a time. Output read by
+    an fd client is not in the replay buffer, nor seen by stream
+    clients."""
+
+    def __init__(self, argv, path, mode=None, winsz=None, replay=65536):
+        if type(argv) == type(''):
+            argv = (argv,)
+        sys.audit('pty.spawn', argv)
+        self.path = path
+        self.replay = replay
+        self.backlog = bytearray()
+        rows, cols = winsz[:2] if winsz else (24, 80)
+        self.screen = _Screen(rows, cols)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._listener.bind(path)
+            self._listener.listen()
+        except:
+            self._listener.close()
+            raise
+        self._listener.setblocking(False)
+        self.pid, self.master_fd = fork(mode, winsz)
+        if self.pid == CHILD:
+            try:
+                os.execlp(argv[0], *argv)
+            finally:
+                os._exit(127)
+        os.set_blocking(self.master_fd, False)
+        self._input = bytearray()  # input not yet written to the master
+
+    def _send(self, client, data):
+        """Queues data for client; False if the client is too far
+        behind and has been dropped."""
+        client.out += data
+        try:
+            n = client.sock.send(client.out)
+        except BlockingIOError:
+            n = 0
+        except OSError:
+            return False
+        del client.out[:n]
+        # A client this far behind reattaches, and gets a snapshot.
+        return len(client.out) <= max(self.replay, 1 << 20)
+
+    def _output(self, data):
+        self.screen.feed(data)
+        backlog = self.backlog
+        backlog += data
+        if len(backlog) > self.replay:
+            del backlog[:len(backlog) - self.replay]
+
+    def _write_master(self):
+        """Writes as much queued input as the master takes."""
+        try:
+            n = os.write(self.master_fd, self._input)
+        except BlockingIOError:
+            n = 0
+        except OSError:
+            n = len(self._input)
+        del self._input[:n]
+
+    def _attach(self, client, mode):
+        """Answers an ATTACH frame; False if the client is refused."""
+        if mode == b"fd":
+            if self._fd_client is not None:
+                return False
+            snapshot = frame(FRAME_DATA, self.screen.snapshot())
+            try:
+                n = socket.send_fds(client.sock, [snapshot], [self.master_fd])
+            except OSError:
+                return False
+            client.out += snapshot[n:]
+            self._fd_client = client
+        elif mode == b"replay":
+            if not self._send(client, frame(FRAME_DATA, bytes(self.backlog))):
+                return False
+        elif not self._send(client, frame(FRAME_DATA, self.screen.snapshot())):
+            return False
+        client.mode = mode
+        return True
+
+    def _handle(self, client, type, payload):
+        """Handles a frame from client; False if the client is to be
+        dropped."""
+        if type == FRAME_ATTACH and client.mode is None:
+            return self._attach(client, payload)
+        elif type == FRAME_DATA:
+            self._input += payload
+            self._write_master()
+        elif type in (FRAME_RESIZE, FRAME_SIGNAL):
+            # A bad frame costs its client the session, not the others.
+            done = _control(type, payload, self.pid, self.master_fd)
+            if done is None:
+                return False
+            if type == FRAME_RESIZE:
+                self.screen.resize(*done)
+        elif type == FRAME_SCREEN and client is self._fd_client:
+            self.screen.reset()
+            self.screen.feed(payload)
+        return True
+
+    def serve(self):
+        """serve() -> status
+        Serves clients until the child exits; returns its exit status
+        value as from os.waitpid()."""
+        sel = selectors.DefaultSelector()
+        rsock, wsock = socket.socketpair()
+        wsock.setblocking(False)
+        self._fd_client = None
+        clients = {}
+        reading = True
+
+        def wake(future):
+            try:
+                wsock.send(b"\0")
+            except OSError:
+                pass
+
+        def drop(client):
+            sel.unregister(client.sock)
+            del clients[client.sock]
+            client.sock.close()
+            if client is self._fd_client:
+                self._fd_client = None
+
+        def read_master():
+            """Reads output; False once the master is at EOF."""
+            try:
+                data = os.read(self.master_fd, 65536)
+            except BlockingIOError:
+                return True
+            except OSError:
+                data = b""
+            if not data:
+                return False
+            self._output(data)
+            out = frame(FRAME_DATA, data)
+            for client in list(clients.values()):
+                if client.mode in (b"stream", b"replay") and \
+                   not self._send(client, out):
+                    drop(client)
+            return True
+
+        future = reaper().watch(self.pid, wake)
+        sel.register(rsock, selectors.EVENT_READ)
+        sel.register(self._listener, selectors.EVENT_READ)
+        try:
+            while not future.done():
+                # The master is left to an fd client while there is one,
+                # and written to while there is input queued.
+                events = 0
+                if reading and self._fd_client is None:
+                    events |= selectors.EVENT_READ
+                if self._input:
+                    events |= selectors.EVENT_WRITE
+                key = sel.get_map().get(self.master_fd)
+                if key is None:
+                    if events:
+                        sel.register(self.master_fd, events)
+                elif not events:
+                    sel.unregister(self.master_fd)
+                elif events != key.events:
+                    sel.modify(self.master_fd, events)
+                for key, mask in sel.select():
+                    if key.fileobj is rsock:
+                        rsock.recv(4096)
+                    elif key.fileobj is self._listener:
+                        try:
+                            sock = self._listener.accept()[0]
+                        except BlockingIOError:
+                            continue
+                        sock.setblocking(False)
+                        clients[sock] = _Client(sock)
+                        sel.register(sock, selectors.EVENT_READ)
+                    elif key.fileobj == self.master_fd:
+                        if mask & selectors.EVENT_WRITE:
+                            self._write_master()
+                        if mask & selectors.EVENT_READ and \
+                           not read_master():
+                            reading = False
+                    elif key.fileobj in clients:
+                        client = clients[key.fileobj]
+                        try:
+                            data = client.sock.recv(65536)
+                        except BlockingIOError:
+                            continue
+                        except OSError:
+                            data = b""
+                        if not data:
+                            drop(client)
+                            continue
+                        for type, payload in client.reader.feed(data):
+                            if not self._handle(client, type, payload):
+                                drop(client)
+                                break
+            status = future.result()[0]
+            # Whatever the child wrote before exiting.
+            if reading and self._fd_client is None:
+                while _ready([self.master_fd]) and read_master():
+                    pass
+            for client in clients.values():
+                client.sock.setblocking(True)
+                client.sock.settimeout(1)
+                try:
+                    client.sock.sendall(bytes(client.out) +
+                                        frame(FRAME_EXIT, pack(">i", status)))
+                except OSError:
+                    pass
+            return status
+        finally:
+            for sock in clients:
+                sock.close()
+            sel.close()
+            rsock.close()
+            wsock.close()
+            self._listener.close()
+            os.close(self.master_fd)
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+def _relay_stdin(fds, detach_key, write):
+    """Reads standard input for attach(); returns True when detach_key
+    has been typed."""
+    data = os.read(STDIN_FILENO, 1024)
+    if not data:
+        fds.remove(STDIN_FILENO)
+        return False
+    i = data.find(detach_key) if detach_key else -1
+    if i >= 0:
+        data = data[:i]
+    if data:
+        write(data)
+    return i >= 0
+
+def _write_wait(fd, data):
+    """os.write() to fd, which may be non-blocking; waits until it can
+    write something."""
+    while True:
+        try:
+            return os.write(fd, data)
+        except BlockingIOError:
+            select([], [fd], [])
+
+def attach(path, mode="stream", detach_key=b"\x1c"):
+    """attach(path) -> status/None
+    Attaches standard input and output to the Session served on path,
+    until the session ends, returning its exit status value, or until
+    detach_key (default ^\\) is typed, returning None. mode is "stream"
+    to relay through the session, starting with a screen snapshot;
+    "replay" to start with the replay buffer instead; or "fd" to be
+    sent the pty master and relay with no copy through the session."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        try:
+            saved = tty.setraw(STDIN_FILENO)
+        except tty.error:
+            saved = None
+        rows, cols = 24, 80
+        try:
+            if saved is not None and tty.HAVE_WINSZ:
+                rows, cols = tty.tcgetwinsize(STDIN_FILENO)[:2]
+                sock.sendall(frame(FRAME_RESIZE,
+                                   pack(">HHHH", rows, cols, 0, 0)))
+            sock.sendall(frame(FRAME_ATTACH, mode.encode()))
+            if mode == "fd":
+                return _attach_fd(sock, detach_key, _Screen(rows, cols))
+            return _attach_stream(sock, detach_key)
+        finally:
+            if saved is not None:
+                tty.tcsetattr(STDIN_FILENO, tty.TCSAFLUSH, saved)
+    finally:
+        sock.close()
+
+def _attach_stream(sock, detach_key):
+    reader = FrameReader()
+    fds = [STDIN_FILENO, sock]
+    write = lambda data: sock.sendall(frame(FRAME_DATA, data))
+    while True:
+        rfds = select(fds, [], [])[0]
+        if STDIN_FILENO in rfds and \
+           _relay_stdin(fds, detach_key, write):
+            return None
+        if sock in rfds:
+            data = sock.recv(65536)
+            if not data:
+                return None
+            for type, payload in reader.feed(data):
+                if type == FRAME_DATA:
+                    _writen(STDOUT_FILENO, payload)
+                elif type == FRAME_EXIT:
+                    return unpack(">i", payload)[0]
+
+def _attach_fd(sock, detach_key, screen):
+    data, fds = socket.recv_fds(sock, 65536, 1)[:2]
+    if not fds:
+        raise OSError(errno.EBUSY, "session has an fd client already")
+    master_fd = fds[0]
+    try:
+        reader = FrameReader()
+        fds = [STDIN_FILENO, master_fd, sock]
+        # The session keeps the master non-blocking.
+        write = lambda data: _writen(master_fd, data, _write_wait)
+        while True:
+            status = None
+            for type, payload in reader.feed(data):
+                if type == FRAME_DATA:
+                    _writen(STDOUT_FILENO, payload)
+                    screen.feed(payload)
+                elif type == FRAME_EXIT:
+                    status = unpack(">i", payload)[0]
+            if status is not None:
+                # Whatever the child wrote before exiting.
+                os.set_blocking(master_fd, False)
+                try:
+                    while data := os.read(master_fd, 65536):
+                        _writen(STDOUT_FILENO, data)
+                except OSError:
+                    pass
+                return status
+
+            data = b""
+            rfds = select(fds, [], [])[0]
+            if STDIN_FILENO in rfds and \
+               _relay_stdin(fds, detach_key, write):
+                sock.sendall(frame(FRAME_SCREEN, screen.snapshot()))
+                return None
+            if master_fd in rfds:
+                try:
+                    out = os.read(master_fd, 65536)
+                except BlockingIOError:
+                    out = None
+                except OSError:
+                    out = b""
+                if out:
+                    _writen(STDOUT_FILENO, out)
+                    screen.feed(out)
+                elif out is not None:
+                    fds.remove(master_fd)
+            if sock in rfds:
+                data = sock.recv(65536)
+                if not data:
+                    return None
+    finally:
+        os.close(master_fd)
+
+def __getattr__(name):
+    # Gateway needs asyncio, which takes longer to import than all the
+    # rest of this module: it is only imported on first use.
+    if name == "Gateway":
+        from pty2_gateway import Gateway
+        return Gateway
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,198 @@
+"""Gateway: pty sessions served over stream sockets by asyncio.
+
+Kept apart from pty2, whose users should not have to import asyncio;
+pty2.Gateway is this module's Gateway."""
+
+from struct import pack
+import asyncio
+import os
+import signal
+import sys
+from pty2 import (FRAME_DATA, FRAME_RESIZE, FRAME_SIGNAL, FRAME_EXIT,
+                  FrameReader, frame, openpty, reaper, _control, _exec,
+                  _killpg)
+
+__all__ = ["Gateway"]
+
+class _GatewayProtocol(asyncio.Protocol):
+    """A connection of a Gateway, and the session it is served."""
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.loop = asyncio.get_running_loop()
+        self.transport = None
+        self.reader = FrameReader()
+        self.data = bytearray()       # output not yet framed and written
+        self.frames = bytearray()     # other frames to write after it
+        self.to_master = bytearray()  # input not yet written to the master
+        self.flushing = False
+        self.reading = False
+        self.eof = False
+        self.kill = None
+        self.pid = None
+        self.master_fd = None
+        self.status = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        gateway = self.gateway
+        try:
+            master_fd, slave_fd = openpty(gateway.mode, gateway.winsz,
+                                          nonblock=True)
+        except OSError:
+            transport.abort()
+            return
+        self.master_fd = master_fd
+        self.pid = _exec(gateway.argv, master_fd, slave_fd)
+        gateway.sessions += 1
+        self._read(True)
+        future = asyncio.wrap_future(reaper().watch(self.pid), loop=self.loop)
+        future.add_done_callback(self._exited)
+
+    def _read(self, reading):
+        """Starts or stops reading the master."""
+        reading = reading and not self.eof
+        if reading != self.reading:
+            if reading:
+                self.loop.add_reader(self.master_fd, self._read_master)
+            else:
+                self.loop.remove_reader(self.master_fd)
+            self.reading = reading
+
+    def _read_master(self):
+        try:
+            data = os.read(self.master_fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._read(False)
+            self.eof = True
+            return
+        self.data += data
+        self._flush_soon()
+
+    def _flush_soon(self):
+        # Whatever is read in one pass of the event loop goes out in one
+        # write, in as few frames as possible.
+        if not self.flushing:
+            self.flushing = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flushing = False
+        if self.transport.is_closing():
+            return
+        out = self.frames
+        if self.data:
+            out = frame(FRAME_DATA, self.data) + out
+        if out:
+            self.transport.write(out)
+        self.data = bytearray()
+        self.frames = bytearray()
+
+    def pause_writing(self):
+        # The client is slow: leave output in the pty, which stops the
+        # session once full.
+        self._read(False)
+
+    def resume_writing(self):
+        self._read(True)
+
+    def data_received(self, data):
+        for type, payload in self.reader.feed(data):
+            if type == FRAME_DATA:
+                self._write_master(payload)
+            elif type in (FRAME_RESIZE, FRAME_SIGNAL) and \
+                 self.status is None:
+                # Parsed as by Session; a bad frame is ignored, since
+                # dropping the client would hang up its session.
+                _control(type, payload, self.pid, self.master_fd)
+
+    def _write_master(self, data=b""):
+        if self.status is not None:
+            return
+        # A writer is registered while there is input left over.
+        waiting = bool(self.to_master)
+        self.to_master += data
+        try:
+            n = os.write(self.master_fd, self.to_master)
+        except BlockingIOError:
+            n = 0
+        except OSError:
+            n = len(self.to_master)
+        del self.to_master[:n]
+        if self.to_master and not waiting:
+            self.loop.add_writer(self.master_fd, self._write_master)
+        elif not self.to_master and waiting:
+            self.loop.remove_writer(self.master_fd)
+
+    def connection_lost(self, exc):
+        if self.status is None and self.pid is not None:
+            # Hang up, as a terminal does when its line drops.
+            self._read(False)
+            _killpg(self.pid, signal.SIGHUP)
+            self.kill = self.loop.call_later(self.gateway.grace, _killpg,
+                                             self.pid, signal.SIGKILL)
+
+    def _exited(self, future):
+        status = self.status = future.result()[0]
+        if self.kill is not None:
+            self.kill.cancel()
+        # Whatever the child wrote before exiting, within reason.
+        while self.reading and len(self.data) < 1 << 20:
+            try:
+                data = os.read(self.master_fd, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            self.data += data
+        self._read(False)
+        self.eof = True
+        if self.to_master:
+            self.loop.remove_writer(self.master_fd)
+        os.close(self.master_fd)
+        self.gateway.sessions -= 1
+        self.frames += frame(FRAME_EXIT, pack(">i", status))
+        self._flush()
+        self.transport.close()
+
+class Gateway:
+    """Gateway(argv, mode=None, winsz=None, grace=1.0)
+    Serves sessions over stream sockets from an asyncio event loop: each
+    connection gets argv run on a pty of its own, made with openpty(mode,
+    winsz), and speaks the frames of Session. DATA frames go both ways,
+    RESIZE frames set the window size of the pty, SIGNAL frames signal
+    the process group of the session, and an EXIT frame with its exit
+    status ends the connection. Output is written to a client once per
+    pass of the event loop, in as few frames as possible. A session
+    whose client goes away is sent SIGHUP, and SIGKILL grace seconds
+    later if it is still running. sessions counts the running ones."""
+
+    def __init__(self, argv, mode=None, winsz=None, grace=1.0):
+        if type(argv) == type(''):
+            argv = (argv,)
+        sys.audit('pty.spawn', argv)
+        self.argv = argv
+        self.mode = mode
+        self.winsz = winsz
+        self.grace = grace
+        self.sessions = 0
+
+    def protocol(self):
+        """Protocol factory for loop.create_server() and the like."""
+        return _GatewayProtocol(self)
+
+    async def serve_unix(self, path, **kwargs):
+        """Returns an asyncio.Server listening on the Unix socket path."""
+        loop = asyncio.get_running_loop()
+        return await loop.create_unix_server(self.protocol, path, **kwargs)
+
+    async def serve_tcp(self, host="127.0.0.1", port=0, **kwargs):
+        """Returns an asyncio.Server listening on host and port. Clients
+        are not authenticated, so host is the loopback interface unless
+        another is given; None or "" is all of them."""
+        loop = asyncio.get_running_loop()
+        return await loop.create_server(self.protocol, host, port, **kwargs)
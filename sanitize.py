@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Turn typescripts into plain text.
+
+Removes escape sequences and control characters exactly like
+pty2.AnsiStripper does on a live session, and normalizes CR LF and lone
+CR to LF like pty2.NewlineNormalizer. Files are memory-mapped and cut
+into pieces that are stripped in parallel by a pool of processes; a
+piece is only ever cut right before an ESC that does not end a string
+sequence, which is where no escape sequence can be split. NumPy, if
+available, is used to strip pieces that hold no escape sequence without
+going through the regular expression.
+
+$ python3 ./sanitize.py -j 8 -o plain/ typescript*
+"""
+import argparse
+import collections
+import mmap
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import pty2
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ESC = 0x1b
+
+if numpy is not None:
+    # Bytes that AnsiStripper removes when they do not follow an ESC.
+    DIRTY = numpy.zeros(256, dtype=bool)
+    DIRTY[:0x20] = True
+    DIRTY[[0x09, 0x0a, 0x0d]] = False
+    DIRTY[0x7f] = True
+
+def cuts(buf, size):
+    """Returns offsets that cut buf into pieces of about size bytes,
+    each of which can be stripped on its own. Only the bytes from each
+    cut to the next ESC are looked at, so that memory use does not grow
+    with the size of buf."""
+    offsets = [0]
+    pos = size
+    while pos < len(buf):
+        pos = buf.find(b"\x1b", pos)
+        # An ESC followed by a backslash ends an OSC, DCS, etc.
+        while pos >= 0 and buf[pos + 1:pos + 2] == b"\\":
+            pos = buf.find(b"\x1b", pos + 1)
+        if pos < 0:
+            break
+        offsets.append(pos)
+        pos += size
+    offsets.append(len(buf))
+    return offsets
+
+def strip(buf):
+    """Strips one piece."""
+    if numpy is not None:
+        arr = numpy.frombuffer(buf, dtype=numpy.uint8)
+        dirty = DIRTY[arr]
+        if not dirty.any():
+            return bytes(buf)
+        if not (arr == ESC).any():
+            # Only lone control characters to remove.
+            return arr[~dirty].tobytes()
+    stripper = pty2.AnsiStripper()
+    data = stripper(buf)
+    return bytes(data) + stripper.flush()
+
+def strip_piece(task):
+    """Worker: strips bytes start to end of the file at path."""
+    path, start, end = task
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view:
+                return strip(view[start:end])
+
+def tasks(path, size):
+    """Yields the pieces of the file at path as (path, start, end)."""
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            offsets = cuts(m, size)
+    for start, end in zip(offsets, offsets[1:]):
+        yield path, start, end
+
+def sanitize(paths, outdir, jobs, size, normalize):
+    """Writes the plain text of each file of paths to outdir, or next to
+    it with a .txt suffix if outdir is None."""
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(jobs) as pool:
+        for path in paths:
+            name = os.path.basename(path) if outdir else path
+            out = os.path.join(outdir or "", name + ".txt")
+            normalizer = pty2.NewlineNormalizer() if normalize else None
+            with open(out, "wb") as f:
+                # Keep a bounded number of pieces in flight, in order.
+                pending = collections.deque()
+                for task in tasks(path, size):
+                    pending.append(pool.submit(strip_piece, task))
+                    if len(pending) > 2 * jobs:
+                        write(f, pending.popleft().result(), normalizer)
+                while pending:
+                    write(f, pending.popleft().result(), normalizer)
+                if normalizer:
+                    f.write(normalizer.flush())
+            print(path, "->", out, file=sys.stderr)
+
+def write(f, data, normalizer):
+    if normalizer:
+        data = normalizer(data)
+    f.write(data)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', dest='jobs', type=int, default=os.cpu_count())
+    parser.add_argument('-o', dest='outdir')
+    parser.add_argument('-s', dest='size', type=int, default=1 << 24,
+                        help='approximate size of the pieces in bytes')
+    parser.add_argument('-r', dest='keep_cr', action='store_true',
+                        help='do not normalize CR LF and CR to LF')
+    parser.add_argument('filename', nargs='+')
+    options = parser.parse_args()
+
+    sanitize(options.filename, options.outdir, options.jobs, options.size,
+             not options.keep_cr)
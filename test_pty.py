@@ -11,6 +11,7 @@ import sys
 import select
 import signal
 import socket
+from struct import pack, unpack
 import io # readline
 import unittest
 
@@ -218,6 +219,36 @@ class PtyTest(unittest.TestCase):
         # to ignore this signal.
         os.close(master_fd)
 
+    def test_openpty_nonblock(self):
+        master_fd, slave_fd, name = pty.openpty(name=True, nonblock=True)
+        self.addCleanup(os.close, master_fd)
+        self.addCleanup(os.close, slave_fd)
+        self.assertFalse(os.get_blocking(master_fd))
+        self.assertFalse(os.get_inheritable(master_fd))
+        self.assertFalse(os.get_inheritable(slave_fd))
+        self.assertEqual(name, os.ttyname(slave_fd))
+
+    def test_openpty_many(self):
+        pairs = pty.openpty_many(3)
+        for master_fd, slave_fd in pairs:
+            self.addCleanup(os.close, master_fd)
+            self.addCleanup(os.close, slave_fd)
+            self.assertTrue(os.isatty(slave_fd))
+        self.assertEqual(len(set(os.ttyname(s) for m, s in pairs)), 3)
+
+    @unittest.skipUnless(pty.HAVE_PTPEER, "needs TIOCGPTPEER")
+    def test_openpty_emfile(self):
+        """Running out of descriptors must not disable TIOCGPTPEER."""
+        import resource
+        limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+        self.addCleanup(resource.setrlimit, resource.RLIMIT_NOFILE, limits)
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (len(os.listdir("/proc/self/fd")) + 16, limits[1]))
+        with self.assertRaises(OSError) as cm:
+            pty.openpty_many(100)
+        self.assertEqual(cm.exception.errno, errno.EMFILE)
+        self.assertTrue(pty.HAVE_PTPEER)
+
     def test_fork(self):
         debug("calling pty.fork()")
         pid, master_fd = pty.fork()
@@ -382,6 +413,344 @@ class PtyTest(unittest.TestCase):
             os.close(slave_fd)
             os.close(master_fd)
 
+    def test_run(self):
+        """Test pty.run() output collection, input and EOF."""
+        debug("calling pty.run()")
+        status, output = pty.run(["cat"], input=TEST_STRING_1, bufsize=8)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        # Echo of the input followed by what cat wrote back.
+        self.assertEqual(normalize_output(output), TEST_STRING_1 * 2)
+
+    def test_run_timeout(self):
+        """Test that pty.run() kills its child upon timeout."""
+        import subprocess
+        with self.assertRaises(subprocess.TimeoutExpired):
+            pty.run(["sleep", "10"], timeout=0.1)
+
+    def test_stream(self):
+        """Test pty.stream() chunks and exit status."""
+        result = {}
+        def consume():
+            result["status"] = yield from pty.stream(["sh", "-c",
+                                                      "echo fish; exit 3"])
+        output = b"".join(consume())
+        self.assertEqual(os.waitstatus_to_exitcode(result["status"]), 3)
+        self.assertEqual(normalize_output(output), b"fish\n")
+
+    def test_run_many(self):
+        """Test pty.run_many() results, timeouts and fail-fast."""
+        commands = [["echo", "fish"], ["sh", "-c", "exit 2"], ["sleep", "10"]]
+        results = pty.run_many(commands, jobs=2, timeout=0.5)
+        self.assertEqual([r.argv for r in results],
+                         [tuple(argv) for argv in commands])
+        self.assertEqual(normalize_output(results[0].output), b"fish\n")
+        self.assertEqual(os.waitstatus_to_exitcode(results[1].status), 2)
+        self.assertTrue(results[2].timed_out)
+        self.assertFalse(results[0].timed_out or results[1].timed_out)
+
+        commands = [["sh", "-c", "exit 2"], ["echo", "fish"]]
+        results = pty.run_many(commands, jobs=1, fail_fast=True)
+        self.assertEqual(os.waitstatus_to_exitcode(results[0].status), 2)
+        self.assertIsNone(results[1])
+
+        # Idle after its first line; SIGHUP ends it within the grace.
+        results = pty.run_many([["sh", "-c", "echo fish; sleep 10"]],
+                               idle=0.2, grace=5)
+        self.assertTrue(results[0].timed_out)
+        self.assertEqual(os.waitstatus_to_exitcode(results[0].status),
+                         -signal.SIGHUP)
+        self.assertLess(results[0].elapsed, 5)
+
+    def test_reaper(self):
+        """Test that pty.reaper() reaps a child and reports its usage."""
+        pid = os.fork()
+        if pid == pty.CHILD:
+            os._exit(3)
+        status, rusage = pty.reaper().watch(pid).result(timeout=5)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 3)
+        self.assertGreaterEqual(rusage.ru_utime, 0)
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(pid, os.WNOHANG)
+
+    def test_feeder(self):
+        """Test pty.Feeder with a slave in canonical mode."""
+        master_fd, slave_fd = pty.openpty()
+        self.addCleanup(os.close, master_fd)
+        self.addCleanup(os.close, slave_fd)
+        mode = tty.tcgetattr(slave_fd)
+        tty.cfmakeecho(mode, False)
+        tty.tcsetattr(slave_fd, tty.TCSANOW, mode)
+        os.set_blocking(master_fd, False)
+        os.set_blocking(slave_fd, False)
+
+        # Far more than MAX_INPUT, in lines of varying length.
+        data = b"".join(TEST_STRING_1[:i % 30] + b"\n" for i in range(5000))
+        feeder = pty.Feeder(master_fd, slave_fd)
+        feeder.feed(data)
+        received = bytearray()
+        while feeder.pending() or len(received) < len(data):
+            feeder.send()
+            try:
+                received += os.read(slave_fd, 1024)
+            except BlockingIOError:
+                pass
+        self.assertEqual(received, data)
+
+    def test_feeder_full_queue(self):
+        """Test pty.Feeder when the slave's input queue is over MAX_INPUT."""
+        master_fd, slave_fd = pty.openpty()
+        self.addCleanup(os.close, master_fd)
+        self.addCleanup(os.close, slave_fd)
+        feeder = pty.Feeder(master_fd, slave_fd)
+        inq = feeder.max_input + 345
+        feeder._inq = lambda: inq
+        feeder.feed(b"".join(TEST_STRING_1[:i % 30] + b"\n"
+                             for i in range(500)))
+        self.assertEqual(len(feeder._next_chunk()), 0)
+        inq = 0
+        chunk = feeder._next_chunk()
+        self.assertTrue(0 < len(chunk) <= feeder.max_input)
+        self.assertEqual(bytes(chunk[-1:]), b"\n")
+
+    def test_feeder_paste(self):
+        """Test that pty.Feeder follows bracketed paste mode."""
+        feeder = pty.Feeder(-1)
+        feeder.observe(b"prompt\x1b[?20")
+        feeder.observe(b"04h$ ")
+        self.assertTrue(feeder.paste)
+        feeder.feed(TEST_STRING_1 + pty.PASTE_END)
+        self.assertEqual(bytes(feeder._next_chunk()),
+                         pty.PASTE_START + TEST_STRING_1 + pty.PASTE_END)
+        feeder.observe(b"\x1b[?2004l")
+        self.assertFalse(feeder.paste)
+
+    def test_session(self):
+        """Test a pty.Session with a stream client and an fd client."""
+        import tempfile
+        import threading
+        path = os.path.join(tempfile.mkdtemp(), "session")
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        session = pty.Session(["sh", "-c", "echo fish; read x; echo $x; "
+                               "read x; echo $x; exit 3"], path)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+                                  session.serve()))
+        thread.start()
+        def stop():
+            pty._killpg(session.pid, signal.SIGKILL)
+            thread.join()
+        self.addCleanup(stop)
+
+        def frames(sock, reader, until):
+            output = b""
+            while until not in output:
+                for type, payload in reader.feed(sock.recv(1024)):
+                    if type == pty.FRAME_EXIT:
+                        return output, payload
+                    output += payload
+            return output, None
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(pty.frame(pty.FRAME_ATTACH, b"stream"))
+            reader = pty.FrameReader()
+            # Either in the first snapshot or in output that follows it.
+            frames(sock, reader, b"fish")
+            sock.sendall(pty.frame(pty.FRAME_DATA, b"license\r"))
+            frames(sock, reader, b"license\r\nlicense\r\n")
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(pty.frame(pty.FRAME_ATTACH, b"fd"))
+            data, fds = socket.recv_fds(sock, 1024, 1)[:2]
+            self.addCleanup(os.close, fds[0])
+            snapshot = pty.FrameReader().feed(data)[0][1]
+            self.assertIn(b"fish\x1b[2;1Hlicense\x1b[3;1Hlicense", snapshot)
+            os.write(fds[0], b"Eric\n")
+            status = frames(sock, pty.FrameReader(), b"\0")[1]
+        thread.join()
+        self.assertEqual(os.waitstatus_to_exitcode(result[0]), 3)
+        self.assertEqual(unpack(">i", status)[0], result[0])
+        self.assertFalse(os.path.exists(path))
+
+    def test_session_input_backlog(self):
+        """Test that input a pty.Session child does not read stalls no
+        other client."""
+        import tempfile
+        import threading
+        path = os.path.join(tempfile.mkdtemp(), "session")
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        session = pty.Session(["sh", "-c", "stty raw -echo; echo fish; "
+                               "sleep 30"], path)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+                                  session.serve()))
+        thread.start()
+        def stop():
+            pty._killpg(session.pid, signal.SIGKILL)
+            thread.join()
+        self.addCleanup(stop)
+
+        with socket.socket(socket.AF_UNIX) as first, \
+             socket.socket(socket.AF_UNIX) as second:
+            first.connect(path)
+            first.sendall(pty.frame(pty.FRAME_ATTACH, b"stream"))
+            output = b""
+            reader = pty.FrameReader()
+            while b"fish" not in output:
+                for type, payload in reader.feed(first.recv(1024)):
+                    output += payload
+            first.sendall(pty.frame(pty.FRAME_DATA, b"x" * 200000))
+
+            second.settimeout(10)
+            second.connect(path)
+            second.sendall(pty.frame(pty.FRAME_ATTACH, b"stream"))
+            reader = pty.FrameReader()
+            self.assertEqual(reader.feed(second.recv(65536))[0][0],
+                             pty.FRAME_DATA)
+            second.sendall(pty.frame(pty.FRAME_SIGNAL,
+                                     pack(">i", signal.SIGKILL)))
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(os.waitstatus_to_exitcode(result[0]),
+                         -signal.SIGKILL)
+
+    def test_session_bad_frames(self):
+        """Test that a pty.Session drops a client that sends a bad frame,
+        and goes on serving others."""
+        import tempfile
+        import threading
+        path = os.path.join(tempfile.mkdtemp(), "session")
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        session = pty.Session(["cat"], path)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+                                  session.serve()))
+        thread.start()
+        def stop():
+            pty._killpg(session.pid, signal.SIGKILL)
+            thread.join()
+        self.addCleanup(stop)
+
+        def frames(sock, reader, until):
+            output = b""
+            while until not in output:
+                for type, payload in reader.feed(sock.recv(1024)):
+                    output += payload
+            return output
+
+        for bad in (pty.frame(pty.FRAME_SIGNAL, pack(">i", 999)),
+                    pty.frame(pty.FRAME_RESIZE, b"\0\0\0")):
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.settimeout(10)
+                sock.connect(path)
+                sock.sendall(pty.frame(pty.FRAME_ATTACH, b"stream") + bad)
+                while sock.recv(1024):
+                    pass
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.settimeout(10)
+            sock.connect(path)
+            # As attach() sends from a terminal that does not know its size.
+            sock.sendall(pty.frame(pty.FRAME_RESIZE, pack(">HHHH", 0, 0, 0, 0))
+                         + pty.frame(pty.FRAME_ATTACH, b"stream")
+                         + pty.frame(pty.FRAME_DATA, b"fish\r"))
+            frames(sock, pty.FrameReader(), b"fish\r\nfish\r\n")
+            sock.sendall(pty.frame(pty.FRAME_SIGNAL,
+                                   pack(">i", signal.SIGKILL)))
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(os.waitstatus_to_exitcode(result[0]),
+                         -signal.SIGKILL)
+
+    def test_gateway(self):
+        """Test pty.Gateway data, signal and exit frames."""
+        import asyncio
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), "gateway")
+        self.addCleanup(os.rmdir, os.path.dirname(path))
+        self.addCleanup(os.unlink, path)
+
+        async def session(reader, writer, until=None):
+            frames = pty.FrameReader()
+            output = b""
+            while True:
+                data = await reader.read(1024)
+                self.assertTrue(data)
+                for type, payload in frames.feed(data):
+                    if type == pty.FRAME_EXIT:
+                        return output, unpack(">i", payload)[0]
+                    output += payload
+                if until is not None and until in output:
+                    return output, None
+
+        async def main():
+            gateway = pty.Gateway(["cat"])
+            server = await gateway.serve_unix(path)
+            reader, writer = await asyncio.open_unix_connection(path)
+            writer.write(pty.frame(pty.FRAME_DATA, b"fish\r"))
+            output = (await session(reader, writer, b"fish\r\nfish\r\n"))[0]
+            self.assertEqual(normalize_output(output), b"fish\nfish\n")
+            self.assertEqual(gateway.sessions, 1)
+            # Bad frames are ignored rather than hanging up the session.
+            writer.write(pty.frame(pty.FRAME_RESIZE, b"\0\0\0") +
+                         pty.frame(pty.FRAME_SIGNAL, pack(">i", 999)) +
+                         pty.frame(pty.FRAME_DATA, b"license\r"))
+            await session(reader, writer, b"license\r\nlicense\r\n")
+            writer.write(pty.frame(pty.FRAME_SIGNAL,
+                                   pack(">i", signal.SIGTERM)))
+            status = (await session(reader, writer))[1]
+            self.assertEqual(os.waitstatus_to_exitcode(status),
+                             -signal.SIGTERM)
+            self.assertEqual(gateway.sessions, 0)
+            writer.close()
+            server.close()
+            await server.wait_closed()
+
+            server = await gateway.serve_tcp()
+            self.assertEqual([sock.getsockname()[0]
+                              for sock in server.sockets], ["127.0.0.1"])
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(main())
+
+    def test_sanitize(self):
+        """Test that sanitize.py cuts a typescript into pieces without
+        changing what AnsiStripper and NewlineNormalizer make of it,
+        with NumPy and without."""
+        import random
+        import sanitize
+        import tempfile
+        from unittest import mock
+        words = [b"\x1b]0;a fish\x07", b"\x1b]2;license\x1b\\", b"\x1bP1$r\x1b\\",
+                 b"\x1b[1;31m", b"\x1b[0m", b"\x1b(B", b"\x1b", b"\\", b"\x07",
+                 b"\r", b"\r\r\n", b"\r\n", b"\n", b"\x00", b"\x7f", b"I wish ",
+                 b"to buy ", b"[", b"]", b";"]
+        rand = random.Random(1)
+        data = b"".join(rand.choice(words) for _ in range(3000))
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        path = os.path.join(tmpdir.name, "typescript")
+        with open(path, "wb") as f:
+            f.write(data)
+
+        for normalize in (False, True):
+            stages = [pty.AnsiStripper()]
+            if normalize:
+                stages.append(pty.NewlineNormalizer())
+            pipeline = pty.Pipeline(*stages)
+            expected = b"".join(bytes(pipeline.feed(data[i:i + 7]))
+                                for i in range(0, len(data), 7))
+            expected += bytes(pipeline.close())
+            for numpy in {None, sanitize.numpy}:
+                with mock.patch.object(sanitize, "numpy", numpy), \
+                     mock.patch("sys.stderr", io.StringIO()):
+                    self.assertGreater(len(sanitize.cuts(data, 3)), 100)
+                    sanitize.sanitize([path], tmpdir.name, 2, 3, normalize)
+                with open(path + ".txt", "rb") as f:
+                    self.assertEqual(f.read(), expected)
+
 class SmallPtyTests(unittest.TestCase):
     """These tests don't spawn children or hang."""
 
@@ -477,6 +846,263 @@ class SmallPtyTests(unittest.TestCase):
             pty._copy(masters[0])
 
 
+    def test__copy_stdin_first(self):
+        """Test that stdin is serviced before master, and that master
+        output keeps being copied within one select call."""
+        read_from_stdout_fd, mock_stdout_fd = self._pipe()
+        pty.STDOUT_FILENO = mock_stdout_fd
+        mock_stdin_fd, write_to_stdin_fd = self._pipe()
+        pty.STDIN_FILENO = mock_stdin_fd
+        socketpair = self._socketpair()
+        masters = [s.fileno() for s in socketpair]
+
+        os.write(masters[1], b'from master')
+        os.write(write_to_stdin_fd, b'from stdin')
+
+        calls = []
+        def master_read(fd):
+            calls.append('master')
+            return os.read(fd, 1)
+        def stdin_read(fd):
+            calls.append('stdin')
+            return os.read(fd, 20)
+
+        pty.select = self._mock_select
+        self.select_rfds_lengths.append(2)
+        self.select_rfds_results.append([masters[0], mock_stdin_fd])
+        self.select_rfds_lengths.append(2)
+
+        with self.assertRaises(IndexError):
+            pty._copy(masters[0], master_read=master_read,
+                      stdin_read=stdin_read)
+
+        self.assertEqual(calls[0], 'stdin')
+        self.assertGreater(len(calls), 2)
+        self.assertEqual(os.read(masters[1], 20), b'from stdin')
+
+    def test_rate_limit(self):
+        limit = pty.RateLimit(1, burst=10)
+        self.assertEqual(limit.delay(), 0)
+        self.assertEqual(limit.admit(TEST_STRING_1), TEST_STRING_1)
+        self.assertGreater(limit.delay(), 0)
+
+        limit = pty.RateLimit(1, burst=10, drop=True)
+        self.assertEqual(limit.admit(b"fish"), b"fish")
+        self.assertEqual(limit.admit(TEST_STRING_1), b"")
+        self.assertEqual(limit.delay(), 0)
+        self.assertEqual(limit.flush(), b"\r\n[%d bytes suppressed]\r\n"
+                                        % len(TEST_STRING_1))
+
+        limit = pty.RateLimit(1, burst=10, auto=1000, window=3600)
+        self.assertEqual(limit.admit(TEST_STRING_1), TEST_STRING_1)
+        self.assertEqual(limit.delay(), 0)
+        limit.window = 0
+        limit.admit(TEST_STRING_1)
+        self.assertTrue(limit.engaged)
+
+    def _feed_chunked(self, stage, data, size):
+        out = [stage(memoryview(data[i:i + size]))
+               for i in range(0, len(data), size)]
+        out.append(stage.flush())
+        return "".join(out) if isinstance(out[-1], str) else b"".join(out)
+
+    def test_timer_wheel(self):
+        now = [1000.0]
+        wheel = pty.TimerWheel(tick=0.01, slots=4, levels=2,
+                               clock=lambda: now[0])
+        fired = []
+        delays = [0.005, 0.05, 0.3, 2.5, 3600, -1]
+        timers = [wheel.call_later(d, fired.append, d) for d in delays]
+        wheel.cancel(timers[2])
+        self.assertEqual(len(wheel), 5)
+        self.assertEqual(wheel.timeout(), 0)
+        self.assertEqual(wheel.advance(), 1)
+        while len(wheel):
+            # Never asked to wake up early, nor late.
+            wait = wheel.timeout()
+            self.assertLessEqual(now[0] + wait, 1000 + min(
+                d for d in delays if d not in fired and d != 0.3) + 0.01)
+            now[0] += wait
+            wheel.advance()
+        self.assertEqual(fired, [-1, 0.005, 0.05, 2.5, 3600])
+        self.assertIsNone(wheel.timeout())
+
+    def test_frame_reader(self):
+        data = (pty.frame(pty.FRAME_DATA, TEST_STRING_1) +
+                pty.frame(pty.FRAME_SIGNAL, pack(">i", signal.SIGINT)))
+        reader = pty.FrameReader()
+        frames = [f for i in range(len(data)) for f in reader.feed(data[i:i + 1])]
+        self.assertEqual(frames, [(pty.FRAME_DATA, TEST_STRING_1),
+                                  (pty.FRAME_SIGNAL, pack(">i", signal.SIGINT))])
+
+    def test_screen(self):
+        """Test that a screen snapshot does not depend on chunking, and
+        redraws the same screen."""
+        data = ("\x1b[1mI wish\x1b[0m to buy\x1b]0;fish\x07\r\n\x1b[2J\x1b[H"
+                "a fish\x1b[3;5Hlicense\x1b[K\r\n\u2603\x1b[2A\x1b[2Deric"
+                "\x1bM\x1b[L\x1b[P").encode()
+        screen = pty._Screen(4, 12)
+        screen.feed(data)
+        snapshot = screen.snapshot()
+        self.assertEqual(snapshot, b"\x1b[0m\x1b[H\x1b[2J\x1b[2;1Ha fish"
+                         b"\x1b[3;1Heric\x1b[4;1H    license"
+                         b"\x1b[1;5H")
+        for size in range(1, len(data) + 1):
+            screen = pty._Screen(4, 12)
+            for i in range(0, len(data), size):
+                screen.feed(data[i:i + size])
+            self.assertEqual(screen.snapshot(), snapshot)
+        screen = pty._Screen(4, 12)
+        screen.feed(snapshot)
+        self.assertEqual(screen.snapshot(), snapshot)
+
+    def test_ansi_stripper(self):
+        """Test that AnsiStripper does not depend on chunking."""
+        data = (b"\x1b[1;31mI wish\x1b[0m to buy\x1b]0;title\x07 a fish"
+                b"\x1b]2;t\x1b\\ license.\x1b(B\x00\r\n\x1b[")
+        expected = b"I wish to buy a fish license.\r\n"
+        for size in range(1, len(data) + 1):
+            self.assertEqual(self._feed_chunked(pty.AnsiStripper(), data,
+                                                size), expected)
+        view = memoryview(TEST_STRING_1)
+        self.assertIs(pty.AnsiStripper()(view), view)
+
+    def test_newline_normalizer(self):
+        data = b"I wish\r\r\nto buy\ra fish\r\n\r\nlicense.\r"
+        for size in range(1, len(data) + 1):
+            self.assertEqual(self._feed_chunked(pty.NewlineNormalizer(), data,
+                                                size),
+                             b"I wish\nto buy\na fish\n\nlicense.\n")
+
+    def test_utf8_decoder(self):
+        data = "Eric the \u2603 fish".encode()
+        self.assertEqual(self._feed_chunked(pty.Utf8Decoder(), data, 1),
+                         "Eric the \u2603 fish")
+
+    def test_redactor(self):
+        import re
+        pattern = re.compile(rb"license\.")
+        data = TEST_STRING_1 * 10
+        expected = data.replace(b"license.", b"[REDACTED]")
+        for size in (1, 7, len(data)):
+            self.assertEqual(self._feed_chunked(pty.Redactor(pattern,
+                                                             window=16),
+                                                data, size), expected)
+
+    def test_pipeline(self):
+        """Test a threaded pipeline feeding a sink."""
+        import zlib
+        sink = []
+        pipeline = pty.Pipeline(pty.AnsiStripper(), pty.Compressor(),
+                                sink=sink.append, thread=True)
+        for chunk in (b"\x1b[1mI wish to", b" buy a fish\x1b", b"[0m license."):
+            pipeline.feed(chunk)
+        pipeline.close()
+        self.assertEqual(zlib.decompress(b"".join(sink)),
+                         b"I wish to buy a fish license.")
+
+        pipeline = pty.Pipeline(pty.AnsiStripper(), pty.Utf8Decoder())
+        self.assertEqual(pipeline.feed(b"\x1b[1mfish \xe2\x98"), "fish ")
+        self.assertEqual(pipeline.feed(b"\x83"), "\u2603")
+        self.assertEqual(pipeline.close(), "")
+
+
+class LoopbackTests(unittest.TestCase):
+    """These tests use the loopback backend; nothing is forked."""
+
+    def setUp(self):
+        # _copy() leaves signals blocked, as spawn() expects.
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+        self.addCleanup(signal.pthread_sigmask, signal.SIG_SETMASK, mask)
+        self.backend = pty.LoopbackBackend()
+        self.master_fd, self.slave_fd = self.backend.openpty()
+
+    def test_canonical(self):
+        b = self.backend
+        b.write(self.master_fd, b"I wish to bx\x7fuy\x15a fish\r")
+        self.assertEqual(b.read(self.slave_fd), b"a fish\n")
+        self.assertEqual(b.read(self.master_fd),
+                         b"I wish to bx\b \buy" + b"\b \b" * 13 +
+                         b"a fish\r\n")
+        b.write(self.master_fd, b"license\x04\x04")
+        self.assertEqual(b.read(self.slave_fd, 4), b"lice")
+        self.assertEqual(b.read(self.slave_fd), b"nse")
+        self.assertEqual(b.read(self.slave_fd), b"")
+        with self.assertRaises(BlockingIOError):
+            b.read(self.slave_fd)
+
+    def test_raw(self):
+        b = self.backend
+        b.write(self.master_fd, b"a fi")
+        mode = b.tcgetattr(self.slave_fd)
+        tty.cfmakeraw(mode)
+        b.tcsetattr(self.slave_fd, tty.TCSANOW, mode)
+        b.write(self.master_fd, b"sh\r\x03")
+        self.assertEqual(b.read(self.master_fd), b"a fi")
+        self.assertEqual(b.read(self.slave_fd), b"a fish\r\x03")
+        b.write(self.slave_fd, b"license\n")
+        self.assertEqual(b.read(self.master_fd), b"license\n")
+        self.assertEqual(b.signals(self.master_fd), [])
+
+    def test_signals_and_winsize(self):
+        b = self.backend
+        b.write(self.master_fd, b"fish\x03")
+        with self.assertRaises(BlockingIOError):
+            b.read(self.slave_fd)
+        self.assertEqual(b.read(self.master_fd), b"fish^C")
+        b.tcsetwinsize(self.master_fd, (40, 100))
+        self.assertEqual(b.tcgetwinsize(self.slave_fd), (40, 100))
+        self.assertEqual(b.signals(self.slave_fd),
+                         [signal.SIGINT, signal.SIGWINCH])
+
+    def test_eof(self):
+        for bsd in (False, True):
+            b = pty.LoopbackBackend(bsd=bsd)
+            master_fd, slave_fd = b.openpty()
+            b.write(slave_fd, b"fish")
+            b.close(slave_fd)
+            self.assertEqual(b.select([master_fd], [], [], 0)[0], [master_fd])
+            self.assertEqual(b.read(master_fd), b"fish")
+            if bsd:
+                self.assertEqual(b.read(master_fd), b"")
+            else:
+                with self.assertRaises(OSError):
+                    b.read(master_fd)
+
+    def test__copy(self):
+        """Test the spawn() relay against an uppercasing child."""
+        b = self.backend
+
+        def child(slave_fd):
+            line = b.read(slave_fd)
+            b.write(slave_fd, line.upper())
+            b.exit(pid, 3)
+
+        pid, master_fd = b.fork(child=child)
+        b.write(b.stdin, b"license\r")
+        b.close(b.stdin)
+        pty._copy(master_fd, backend=b)
+        self.assertEqual(b.read(b.stdout), b"license\r\nLICENSE\r\n")
+        self.assertEqual(b.waitpid(pid, 0), (pid, 3 << 8))
+
+    def test_spawn(self):
+        """Test pty.spawn() running a loopback program."""
+        b = self.backend
+
+        def upper(argv, pid, slave_fd):
+            b.write(slave_fd, b.read(slave_fd).upper())
+            b.exit(pid, 3)
+
+        b.programs["upper"] = upper
+        b.write(b.stdin, b"license\r")
+        b.close(b.stdin)
+        status = pty.spawn(["upper"], backend=b)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 3)
+        self.assertEqual(b.read(b.stdout), b"license\r\nLICENSE\r\n")
+        status = pty.spawn("fish", backend=b)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 127)
+
+
 def tearDownModule():
     reap_children()
 